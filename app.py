@@ -1,19 +1,33 @@
 import os
+import ast
 import uuid
 import base64
 import json
+import math
 import subprocess
 import requests
+import requests.adapters
+import httpx
 import shutil
+import sqlite3
+import hashlib
 import atexit
 import time
+import random
+import re
+import contextvars
+from contextlib import contextmanager
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict
+from types import SimpleNamespace
+from typing import Callable, List, Dict, Optional, Tuple, Union
 
 import numpy as np
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
-from openai import OpenAI
+from openai import APIConnectionError, DefaultHttpxClient, OpenAI
 from dotenv import load_dotenv
 from supabase import create_client, Client
 
@@ -23,23 +37,126 @@ load_dotenv()
 # --- Supabase config ---
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
 
 # --- config ---
+# Created on first use, so importing the app (e.g. gunicorn --preload) touches no disk
 UPLOAD_FOLDER = Path("uploads")
 FRAMES_FOLDER = Path("frames")
-UPLOAD_FOLDER.mkdir(exist_ok=True)
-FRAMES_FOLDER.mkdir(exist_ok=True)
+JOBS_FOLDER = Path("jobs")
 
 FPS = 0.5  # lower fps to reduce frame count and token usage
 MAX_FRAMES_TO_ANALYZE = 6  # fewer frames analyzed to cut cost/TPM
 MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", 5))
 RETRY_BASE_DELAY = float(os.environ.get("OPENAI_RETRY_BASE_DELAY", 0.8))
+# Max vision calls in flight per job
+FRAME_ANALYSIS_CONCURRENCY = max(1, int(os.environ.get("FRAME_ANALYSIS_CONCURRENCY", MAX_FRAMES_TO_ANALYZE)))
+# Stream the summary feedback instead of waiting for the whole JSON reply
+SUMMARY_STREAM = os.environ.get("SUMMARY_STREAM", "0").lower() in ("1", "true", "yes")
+# Frames sent per vision request; >1 pays the instruction prompt once per batch
+VISION_BATCH_SIZE = max(1, int(os.environ.get("VISION_BATCH_SIZE", 1)))
+# Ask for replies that match a strict JSON schema; "0" falls back to plain JSON mode
+STRUCTURED_OUTPUTS = os.environ.get("STRUCTURED_OUTPUTS", "1").lower() in ("1", "true", "yes")
+# Follow-up requests for a reply that stays unparseable after local repair
+STRUCTURED_OUTPUT_RETRIES = max(0, int(os.environ.get("STRUCTURED_OUTPUT_RETRIES", 1)))
+
+# Frame extraction: "seek" decodes only the sampled frames, "fps" decodes the whole video
+FRAME_EXTRACTION_MODE = os.environ.get("FRAME_EXTRACTION_MODE", "seek").lower()
+FRAME_EXTRACTION_WORKERS = max(1, int(os.environ.get("FRAME_EXTRACTION_WORKERS", os.cpu_count() or 2)))
+
+# Frame selection: "linspace" samples evenly, "scene" skips near-duplicate and blurry frames,
+# "adaptive" analyzes a coarse set first and adds frames only where neighbouring samples disagree
+FRAME_SELECTION_MODE = os.environ.get("FRAME_SELECTION_MODE", "linspace").lower()
+SCENE_CANDIDATE_FPS = float(os.environ.get("SCENE_CANDIDATE_FPS", 1.0))
+SCENE_THUMB_SIZE = 64
+SCENE_DUP_HASH_DISTANCE = int(os.environ.get("SCENE_DUP_HASH_DISTANCE", 6))  # of 64 hash bits
+SCENE_DUP_DIFF = float(os.environ.get("SCENE_DUP_DIFF", 6.0))  # mean gray-level difference
+SCENE_BLUR_RATIO = float(os.environ.get("SCENE_BLUR_RATIO", 0.35))  # of median sharpness
+ADAPTIVE_COARSE_FRAMES = max(2, int(os.environ.get("ADAPTIVE_COARSE_FRAMES", 3)))
+ADAPTIVE_MAX_FRAMES = int(os.environ.get("ADAPTIVE_MAX_FRAMES", MAX_FRAMES_TO_ANALYZE))  # ceiling per video
+ADAPTIVE_SCORE_SPREAD = float(os.environ.get("ADAPTIVE_SCORE_SPREAD", 10))  # max skill_score gap to agree
+ADAPTIVE_ISSUE_SPREAD = int(os.environ.get("ADAPTIVE_ISSUE_SPREAD", 1))  # max gap in errors/safety issue counts
+
+# Frame source: "pipe" keeps frames in memory, "disk" writes them under FRAMES_FOLDER
+FRAME_SOURCE = os.environ.get("FRAME_SOURCE", "pipe").lower()
+
+# Image preparation before vision calls. Frames are downscaled to fit IMAGE_TILE_GRID
+# 512px tiles ("<long side>x<short side>", "off" keeps full resolution) and encoded at
+# ffmpeg JPEG qscale IMAGE_JPEG_QSCALE (2 = best, 31 = smallest)
+IMAGE_TILE_GRID = os.environ.get("IMAGE_TILE_GRID", "2x1").lower()
+IMAGE_JPEG_QSCALE = min(31, max(2, int(os.environ.get("IMAGE_JPEG_QSCALE", 5))))
+IMAGE_MAX_BYTES = int(os.environ.get("IMAGE_MAX_BYTES", 0))  # re-encode coarser above this, 0 = no budget
+# "auto" sends detail=low for frames that fit one tile (nothing is lost), "low"/"high" force it
+IMAGE_DETAIL = os.environ.get("IMAGE_DETAIL", "auto").lower()
+# Crop every frame to the box where the video moves, found by differencing thumbnails
+IMAGE_MOTION_CROP = os.environ.get("IMAGE_MOTION_CROP", "0").lower() in ("1", "true", "yes")
+IMAGE_MOTION_THRESHOLD = float(os.environ.get("IMAGE_MOTION_THRESHOLD", 8.0))  # mean gray-level change
+IMAGE_MOTION_MARGIN = float(os.environ.get("IMAGE_MOTION_MARGIN", 0.1))  # of frame size, around the box
+IMAGE_MOTION_MAX_AREA = 0.8  # larger boxes aren't worth cropping to
+IMAGE_TILE_SIZE = 512
+# (base, per tile) tokens an image costs; gpt-4o-mini bills images at ~33x the usual rate
+IMAGE_TOKEN_COSTS = {"gpt-4o-mini": (2833, 5667)}
+DEFAULT_IMAGE_TOKEN_COST = (85, 170)
+
+# Streaming video download
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", 1024 * 1024))
+DOWNLOAD_MAX_RESUMES = int(os.environ.get("DOWNLOAD_MAX_RESUMES", 3))
+DOWNLOAD_TIMEOUT = float(os.environ.get("DOWNLOAD_TIMEOUT", 60))
+
+# Content-addressed result cache (SQLite, shared by all workers on the host)
+CACHE_ENABLED = os.environ.get("ANALYSIS_CACHE_ENABLED", "1").lower() in ("1", "true", "yes")
+CACHE_DB_PATH = Path(os.environ.get("ANALYSIS_CACHE_PATH", "cache/analysis_cache.sqlite3"))
+CACHE_MAX_BYTES = int(os.environ.get("ANALYSIS_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+# Metrics for GET /metrics (SQLite, aggregated across workers on the host)
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1").lower() in ("1", "true", "yes")
+METRICS_DB_PATH = Path(os.environ.get("METRICS_PATH", "cache/metrics.sqlite3"))
+HISTOGRAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Cross-worker OpenAI rate governor (SQLite token buckets shared by all workers on the host).
+# The limits are starting values; x-ratelimit-* response headers replace them.
+RATE_GOVERNOR_ENABLED = os.environ.get("RATE_GOVERNOR_ENABLED", "1").lower() in ("1", "true", "yes")
+RATE_GOVERNOR_DB_PATH = Path(os.environ.get("RATE_GOVERNOR_PATH", "cache/rate_governor.sqlite3"))
+OPENAI_RPM_LIMIT = int(os.environ.get("OPENAI_RPM_LIMIT", 500))
+OPENAI_TPM_LIMIT = int(os.environ.get("OPENAI_TPM_LIMIT", 200000))
+RATE_GOVERNOR_HEADROOM = float(os.environ.get("RATE_GOVERNOR_HEADROOM", 0.9))  # fraction of the limits to use
+RATE_GOVERNOR_JITTER = float(os.environ.get("RATE_GOVERNOR_JITTER", 0.25))  # max seconds added to each wait
+IMAGE_TOKEN_ESTIMATE = int(os.environ.get("IMAGE_TOKEN_ESTIMATE", 0))  # per unreadable image, 0 = model's largest
+
+# Connection pools. Clients are created on first use, once per worker process.
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 16))  # keep-alive connections per host for downloads
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", 64))
+OPENAI_KEEPALIVE_CONNECTIONS = int(os.environ.get("OPENAI_KEEPALIVE_CONNECTIONS", 32))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get("OPENAI_KEEPALIVE_EXPIRY", 60))
+
+# Seconds between keep-alive comments on /upload/stream
+SSE_KEEPALIVE_SECONDS = float(os.environ.get("SSE_KEEPALIVE_SECONDS", 10))
+
+# Batch analysis (POST /upload/batch)
+BATCH_MAX_VIDEOS = int(os.environ.get("BATCH_MAX_VIDEOS", 50))
+BATCH_PREPARE_WORKERS = max(1, int(os.environ.get("BATCH_PREPARE_WORKERS", 4)))
+OFFLINE_BATCH_POLL_SECONDS = float(os.environ.get("OFFLINE_BATCH_POLL_SECONDS", 30))
+OFFLINE_BATCH_MAX_WAIT_SECONDS = float(os.environ.get("OFFLINE_BATCH_MAX_WAIT_SECONDS", 25 * 3600))
+OFFLINE_BATCH_CLAIM_SECONDS = float(os.environ.get("OFFLINE_BATCH_CLAIM_SECONDS", 3600))  # stale poller lock
+
+# Async job mode (POST /upload with "async": true, then GET /jobs/<job_id>)
+JOB_WORKERS = max(1, int(os.environ.get("JOB_WORKERS", 2)))
+JOB_QUEUE_DEPTH = max(1, int(os.environ.get("JOB_QUEUE_DEPTH", 8)))
+JOB_RETRY_AFTER_SECONDS = int(os.environ.get("JOB_RETRY_AFTER_SECONDS", 30))
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", 24 * 3600))
+JOB_HEARTBEAT_SECONDS = float(os.environ.get("JOB_HEARTBEAT_SECONDS", 10))
+PIPELINE_STAGES = ["download", "extract", "analyze", "summary"]
 
 # Models – tweak if you want
 VISION_MODEL = "gpt-4o-mini"
 SUMMARY_MODEL = "gpt-4o-mini"
 
+# A frame is either a JPEG on disk or JPEG bytes held in memory
+Frame = Union[Path, bytes]
+# Region of a frame as (x, y, width, height) fractions of its size
+CropBox = Tuple[float, float, float, float]
+JPEG_SOI = b"\xff\xd8"
+JPEG_EOI = b"\xff\xd9"
+
 # Cleanup function for temporary files
 def cleanup_temp_files():
     """Clean up temporary upload and frame directories"""
@@ -58,10 +175,63 @@ def cleanup_temp_files():
 # Register cleanup on exit
 atexit.register(cleanup_temp_files)
 
-# OpenAI client – expects OPENAI_API_KEY in env
-client = OpenAI(
-    api_key=os.environ.get("OPENAI_API_KEY"),
-)
+# ---------- clients ----------
+
+
+_clients_lock = threading.Lock()
+_clients: Dict[str, object] = {}
+_clients_pid = None
+
+
+def _per_process(name: str, factory: Callable[[], object]):
+    """
+    Return the named client for this process, creating it on first use.
+    Clients inherited through a fork (gunicorn --preload) are dropped, not
+    reused, so workers never share connection pools or sockets.
+    """
+    global _clients_pid
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            _clients.clear()
+            _clients_pid = os.getpid()
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
+
+
+def get_supabase() -> Client:
+    return _per_process("supabase", lambda: create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY))
+
+
+def get_openai_client() -> OpenAI:
+    """OpenAI client – expects OPENAI_API_KEY in env. Keeps connections alive between calls."""
+    return _per_process(
+        "openai",
+        lambda: OpenAI(
+            api_key=os.environ.get("OPENAI_API_KEY"),
+            http_client=DefaultHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=OPENAI_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+                ),
+            ),
+        ),
+    )
+
+
+def _new_http_session() -> requests.Session:
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_http_session() -> requests.Session:
+    """Shared session for storage downloads, so repeat jobs reuse TCP/TLS connections."""
+    return _per_process("http", _new_http_session)
+
 
 app = Flask(__name__)
 
@@ -79,7 +249,92 @@ else:
 
 # ---------- helpers ----------
 
-def extract_frames(video_path: Path, out_dir: Path, fps: int = 1) -> List[Path]:
+def image_tile_grid() -> Optional[Tuple[int, int]]:
+    """(long side, short side) in tiles that frames are scaled to fit, None for full resolution."""
+    if IMAGE_DETAIL == "low":
+        # Low detail is billed as one 512px image whatever the size
+        return (1, 1)
+    if IMAGE_TILE_GRID in ("", "0", "off"):
+        return None
+    long_tiles, short_tiles = (int(n) for n in IMAGE_TILE_GRID.split("x"))
+    return long_tiles, short_tiles
+
+
+def image_filter(crop: Optional[CropBox] = None) -> str:
+    """
+    ffmpeg filter chain that prepares an extracted frame for the vision model:
+    crop to `crop`, then downscale (never up) to fit image_tile_grid() tiles
+    with the aspect ratio kept, so one side lands on a tile boundary.
+    """
+    filters = []
+    if crop is not None:
+        x, y, w, h = crop
+        filters.append(f"crop=iw*{w:.4f}:ih*{h:.4f}:iw*{x:.4f}:ih*{y:.4f}")
+    grid = image_tile_grid()
+    if grid is not None:
+        long_side, short_side = grid[0] * IMAGE_TILE_SIZE, grid[1] * IMAGE_TILE_SIZE
+        filters.append(
+            f"scale='min(iw,if(gte(iw,ih),{long_side},{short_side}))'"
+            f":'min(ih,if(gte(iw,ih),{short_side},{long_side}))'"
+            ":force_original_aspect_ratio=decrease"
+        )
+    return ",".join(filters)
+
+
+def jpeg_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """(width, height) from a JPEG's start-of-frame header, or None if there isn't one."""
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            i += 1
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = int.from_bytes(data[i + 5 : i + 7], "big")
+            width = int.from_bytes(data[i + 7 : i + 9], "big")
+            return width, height
+        i += 2 + int.from_bytes(data[i + 2 : i + 4], "big")
+    return None
+
+
+def fit_jpeg_budget(data: bytes) -> bytes:
+    """
+    Re-encode a JPEG at coarser qscales until it fits IMAGE_MAX_BYTES
+    (0 = no budget). Every attempt starts from the original, not the last try.
+    """
+    qscale = IMAGE_JPEG_QSCALE
+    fitted = data
+    while IMAGE_MAX_BYTES and len(fitted) > IMAGE_MAX_BYTES and qscale < 31:
+        qscale = min(31, qscale * 2)
+        result = subprocess.run(
+            ["ffmpeg", "-f", "image2pipe", "-i", "pipe:0", "-q:v", str(qscale),
+             "-f", "image2pipe", "-vcodec", "mjpeg", "pipe:1"],
+            input=data,
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        fitted = result.stdout or fitted
+    return fitted
+
+
+def fit_frame_budget(frame: Frame) -> Frame:
+    """fit_jpeg_budget for a frame in memory or on disk (rewritten in place)."""
+    if not IMAGE_MAX_BYTES:
+        return frame
+    if isinstance(frame, bytes):
+        return fit_jpeg_budget(frame)
+    data = frame.read_bytes()
+    fitted = fit_jpeg_budget(data)
+    if fitted is not data:
+        frame.write_bytes(fitted)
+    return frame
+
+
+def extract_frames(video_path: Path, out_dir: Path, fps: int = 1, crop: Optional[CropBox] = None) -> List[Path]:
     """
     Use ffmpeg to extract frames from the video at a fixed FPS.
     Returns a sorted list of frame image paths.
@@ -92,9 +347,9 @@ def extract_frames(video_path: Path, out_dir: Path, fps: int = 1) -> List[Path]:
         "-i",
         str(video_path),
         "-vf",
-        f"fps={fps}",
+        ",".join(filter(None, [f"fps={fps}", image_filter(crop)])),
         "-q:v",
-        "2",
+        str(IMAGE_JPEG_QSCALE),
         str(pattern),
     ]
     # Suppress ffmpeg noise in console
@@ -109,50 +364,470 @@ def extract_frames(video_path: Path, out_dir: Path, fps: int = 1) -> List[Path]:
     return frames
 
 
-def encode_image_to_data_url(path: Path) -> str:
-    with open(path, "rb") as f:
-        b64 = base64.b64encode(f.read()).decode("utf-8")
+def probe_duration(video_path: Path) -> float:
+    """Return the container duration in seconds using ffprobe."""
+    cmd = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-show_entries",
+        "format=duration",
+        "-of",
+        "default=noprint_wrappers=1:nokey=1",
+        str(video_path),
+    ]
+    result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+    return float(result.stdout.strip())
+
+
+def sample_timestamps(duration: float, fps: float, max_frames: int) -> List[float]:
+    """
+    Timestamps that extract_frames at `fps` followed by np.linspace sampling
+    of `max_frames` would pick, computed without decoding anything
+    (bench/check_sampling.py compares the two on real clips).
+    """
+    # The fps filter emits one frame per 1/fps seconds, rounding to the nearest output slot
+    total = max(1, int(math.floor(duration * fps + 0.5))) if duration > 0 else 0
+    if total == 0:
+        return []
+    num_frames_to_use = min(max_frames, total)
+    indices = np.linspace(0, total - 1, num_frames_to_use, dtype=int)
+    return [i / float(fps) for i in indices]
+
+
+def extract_frame_at(
+    video_path: Path, timestamp_sec: float, out_path: Optional[Path] = None, crop: Optional[CropBox] = None
+) -> Optional[Frame]:
+    """
+    Decode a single frame at timestamp_sec using fast input seeking, prepared
+    by image_filter(crop).
+    Writes the JPEG to out_path, or with out_path=None reads it from ffmpeg's
+    stdout and returns the bytes.
+    Returns None if ffmpeg produced no frame (e.g. seek past the end).
+    """
+    cmd = [
+        "ffmpeg",
+        "-ss",
+        f"{timestamp_sec:.3f}",
+        "-i",
+        str(video_path),
+        "-frames:v",
+        "1",
+        "-q:v",
+        str(IMAGE_JPEG_QSCALE),
+    ]
+    vf = image_filter(crop)
+    if vf:
+        cmd += ["-vf", vf]
+    if out_path is None:
+        cmd += ["-f", "image2pipe", "-vcodec", "mjpeg", "pipe:1"]
+        result = subprocess.run(
+            cmd,
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        return result.stdout or None
+
+    cmd += ["-y", str(out_path)]
+    subprocess.run(
+        cmd,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return out_path if out_path.exists() else None
+
+
+def split_jpeg_stream(data: bytes) -> List[bytes]:
+    """
+    Split concatenated JPEGs (ffmpeg image2pipe/mjpeg output) into single images.
+    The EOI marker FFD9 can't occur inside entropy-coded data thanks to byte
+    stuffing, so it is a safe delimiter for ffmpeg's encoder output.
+    """
+    images = []
+    start = data.find(JPEG_SOI)
+    while start != -1:
+        end = data.find(JPEG_EOI, start + len(JPEG_SOI))
+        if end == -1:
+            break
+        end += len(JPEG_EOI)
+        images.append(data[start:end])
+        start = data.find(JPEG_SOI, end)
+    return images
+
+
+def extract_frames_to_memory(video_path: Path, fps: float, crop: Optional[CropBox] = None) -> List[bytes]:
+    """
+    Like extract_frames, but ffmpeg writes MJPEG to a pipe and the frames are
+    split in memory instead of going through a temp directory.
+    """
+    cmd = [
+        "ffmpeg",
+        "-i",
+        str(video_path),
+        "-vf",
+        ",".join(filter(None, [f"fps={fps}", image_filter(crop)])),
+        "-q:v",
+        str(IMAGE_JPEG_QSCALE),
+        "-f",
+        "image2pipe",
+        "-vcodec",
+        "mjpeg",
+        "pipe:1",
+    ]
+    result = subprocess.run(
+        cmd,
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    return split_jpeg_stream(result.stdout)
+
+
+def extract_frames_at(
+    video_path: Path,
+    out_dir: Optional[Path],
+    timestamps: List[float],
+    first_index: int = 0,
+    crop: Optional[CropBox] = None,
+) -> List[Tuple[Frame, float]]:
+    """
+    Seek to each timestamp in parallel and decode one frame there, cropped to
+    `crop` and fitted to the image budget. Frames are written under out_dir
+    (numbered from first_index), or kept in memory as JPEG bytes when out_dir is None.
+    Returns (frame, timestamp_sec) pairs in timestamp order.
+    """
+    if not timestamps:
+        return []
+    if out_dir is not None:
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+    def _extract(item: Tuple[int, float]) -> Optional[Frame]:
+        n, timestamp_sec = item
+        out_path = out_dir / f"frame_{first_index + n:04d}.jpg" if out_dir is not None else None
+        frame = extract_frame_at(video_path, timestamp_sec, out_path, crop)
+        return fit_frame_budget(frame) if frame is not None else None
+
+    workers = min(FRAME_EXTRACTION_WORKERS, len(timestamps))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="frame-extract") as pool:
+        frames = list(pool.map(_extract, enumerate(timestamps)))
+
+    return [(frame, ts) for frame, ts in zip(frames, timestamps) if frame is not None]
+
+
+def extract_sampled_frames(
+    video_path: Path, out_dir: Optional[Path], fps: float, max_frames: int, crop: Optional[CropBox] = None
+) -> List[Tuple[Frame, float]]:
+    """
+    Probe the duration, compute the sampled timestamps up front and seek to each
+    one in parallel (see extract_frames_at).
+    """
+    timestamps = sample_timestamps(probe_duration(video_path), fps, max_frames)
+    return extract_frames_at(video_path, out_dir, timestamps, crop=crop)
+
+
+def extract_thumbnails(video_path: Path, fps: float, size: int) -> np.ndarray:
+    """
+    Decode the video once at `fps` into size x size grayscale thumbnails.
+    Returns a uint8 array of shape (num_frames, size, size); frame k is at k / fps.
+    """
+    cmd = [
+        "ffmpeg",
+        "-i",
+        str(video_path),
+        "-vf",
+        f"fps={fps},scale={size}:{size},format=gray",
+        "-f",
+        "rawvideo",
+        "pipe:1",
+    ]
+    result = subprocess.run(
+        cmd,
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    frame_bytes = size * size
+    count = len(result.stdout) // frame_bytes
+    return np.frombuffer(result.stdout[: count * frame_bytes], dtype=np.uint8).reshape(count, size, size)
+
+
+def average_hash(thumbs: np.ndarray, hash_size: int = 8) -> np.ndarray:
+    """Perceptual (average) hash per thumbnail as a (N, hash_size**2) bool array."""
+    n, h, w = thumbs.shape
+    blocks = thumbs.reshape(n, hash_size, h // hash_size, hash_size, w // hash_size).mean(axis=(2, 4))
+    return (blocks > blocks.mean(axis=(1, 2), keepdims=True)).reshape(n, -1)
+
+
+def laplacian_variance(thumbs: np.ndarray) -> np.ndarray:
+    """Sharpness per thumbnail: variance of the 4-neighbour Laplacian (low = blurry)."""
+    t = thumbs.astype(np.float32)
+    lap = (
+        t[:, :-2, 1:-1] + t[:, 2:, 1:-1] + t[:, 1:-1, :-2] + t[:, 1:-1, 2:]
+        - 4.0 * t[:, 1:-1, 1:-1]
+    )
+    return lap.reshape(len(t), -1).var(axis=1)
+
+
+def select_distinct_indices(thumbs: np.ndarray, budget: int) -> Tuple[List[int], Dict]:
+    """
+    Pick up to `budget` thumbnail indices that show distinct, sharp moments.
+    - Frames much blurrier than the video's median sharpness are dropped
+    - Consecutive frames within SCENE_DUP_HASH_DISTANCE hash bits and
+      SCENE_DUP_DIFF mean gray-level difference of their run's first frame
+      are collapsed into that run, represented by its sharpest frame
+    - If more distinct runs remain than the budget, they are sampled evenly
+    Returns (indices in time order, counts of what was skipped).
+    """
+    n = len(thumbs)
+    sharpness = laplacian_variance(thumbs)
+    hashes = average_hash(thumbs)
+
+    blurry = sharpness < SCENE_BLUR_RATIO * np.median(sharpness)
+    candidates = np.flatnonzero(~blurry)
+    if len(candidates) == 0:
+        # Uniformly soft footage: judge on content alone
+        candidates = np.arange(n)
+        blurry[:] = False
+
+    runs: List[List[int]] = []
+    for i in candidates:
+        if runs:
+            anchor = runs[-1][0]
+            hash_dist = int(np.count_nonzero(hashes[i] != hashes[anchor]))
+            diff = float(np.abs(thumbs[i].astype(np.int16) - thumbs[anchor]).mean())
+            if hash_dist <= SCENE_DUP_HASH_DISTANCE and diff <= SCENE_DUP_DIFF:
+                runs[-1].append(int(i))
+                continue
+        runs.append([int(i)])
+
+    representatives = [max(run, key=lambda i: sharpness[i]) for run in runs]
+    if len(representatives) > budget:
+        picks = np.linspace(0, len(representatives) - 1, budget, dtype=int)
+        representatives = [representatives[p] for p in picks]
+
+    stats = {
+        "candidates": n,
+        "blurry": int(blurry.sum()),
+        "near_duplicates": len(candidates) - len(runs),
+        "selected": len(representatives),
+    }
+    return representatives, stats
+
+
+def motion_crop_box(thumbs: np.ndarray) -> Optional[CropBox]:
+    """
+    Box around where the video moves: pixels whose mean gray-level change between
+    consecutive thumbnails exceeds IMAGE_MOTION_THRESHOLD, with the outermost 2%
+    on each side trimmed as noise and IMAGE_MOTION_MARGIN added around it.
+    None if nothing moves or the box would cover most of the frame anyway.
+    """
+    if len(thumbs) < 2:
+        return None
+    motion = np.abs(np.diff(thumbs.astype(np.int16), axis=0)).mean(axis=0)
+    ys, xs = np.nonzero(motion > IMAGE_MOTION_THRESHOLD)
+    if len(xs) == 0:
+        return None
+
+    _, height, width = thumbs.shape
+    x0, x1 = np.percentile(xs, [2, 98])
+    y0, y1 = np.percentile(ys, [2, 98])
+    left = max(0.0, x0 / width - IMAGE_MOTION_MARGIN)
+    right = min(1.0, (x1 + 1) / width + IMAGE_MOTION_MARGIN)
+    top = max(0.0, y0 / height - IMAGE_MOTION_MARGIN)
+    bottom = min(1.0, (y1 + 1) / height + IMAGE_MOTION_MARGIN)
+    if (right - left) * (bottom - top) > IMAGE_MOTION_MAX_AREA:
+        return None
+    return (float(left), float(top), float(right - left), float(bottom - top))
+
+
+def find_motion_crop(video_path: Path) -> Optional[CropBox]:
+    """motion_crop_box over thumbnails sampled at SCENE_CANDIDATE_FPS; None if that fails."""
+    try:
+        crop = motion_crop_box(extract_thumbnails(video_path, SCENE_CANDIDATE_FPS, SCENE_THUMB_SIZE))
+    except (subprocess.CalledProcessError, ValueError, OSError) as e:
+        print(f"⚠️ Motion crop failed, sending whole frames: {e}")
+        return None
+    if crop is not None:
+        print(f"✂️ Motion crop: {crop[2] * crop[3]:.0%} of the frame at ({crop[0]:.2f}, {crop[1]:.2f})")
+    return crop
+
+
+def extract_scene_frames(
+    video_path: Path, out_dir: Optional[Path], max_frames: int, crop: Optional[CropBox] = None
+) -> List[Tuple[Frame, float]]:
+    """
+    Score low-res thumbnails sampled at SCENE_CANDIDATE_FPS, keep up to max_frames
+    distinct sharp moments (see select_distinct_indices) and decode only those at
+    full resolution.
+    """
+    thumbs = extract_thumbnails(video_path, SCENE_CANDIDATE_FPS, SCENE_THUMB_SIZE)
+    if len(thumbs) == 0:
+        return []
+
+    indices, stats = select_distinct_indices(thumbs, max_frames)
+    print(
+        f"🎯 Scene selection: {stats['selected']} of {stats['candidates']} candidate frames "
+        f"(skipped {stats['near_duplicates']} near-duplicate, {stats['blurry']} blurry)"
+    )
+    timestamps = [i / float(SCENE_CANDIDATE_FPS) for i in indices]
+    return extract_frames_at(video_path, out_dir, timestamps, crop=crop)
+
+
+def select_frames(
+    video_path: Path, out_dir: Optional[Path], coarse: bool = False, crop: Optional[CropBox] = None
+) -> List[Tuple[Frame, float]]:
+    """
+    Extract up to MAX_FRAMES_TO_ANALYZE frames sampled evenly across the video.
+    Uses seek-based extraction when FRAME_EXTRACTION_MODE is "seek" and falls back
+    to decoding the whole video at FPS if the duration can't be probed.
+    With FRAME_SELECTION_MODE "scene", near-duplicate and blurry frames are skipped
+    instead (see extract_scene_frames).
+    With coarse=True only ADAPTIVE_COARSE_FRAMES are sampled; analyze_adaptively adds more.
+    Frames are cropped to `crop` and prepared for the vision model (see image_filter).
+    With out_dir=None frames stay in memory as JPEG bytes.
+    """
+    max_frames = ADAPTIVE_COARSE_FRAMES if coarse else MAX_FRAMES_TO_ANALYZE
+    if FRAME_SELECTION_MODE == "scene":
+        try:
+            return extract_scene_frames(video_path, out_dir, MAX_FRAMES_TO_ANALYZE, crop)
+        except (subprocess.CalledProcessError, ValueError, OSError) as e:
+            print(f"⚠️ Scene-aware selection failed, sampling evenly instead: {e}")
+
+    if FRAME_EXTRACTION_MODE == "seek":
+        try:
+            return extract_sampled_frames(video_path, out_dir, FPS, max_frames, crop)
+        except (subprocess.CalledProcessError, ValueError, OSError) as e:
+            print(f"⚠️ Seek-based extraction failed, decoding full video instead: {e}")
+
+    if out_dir is None:
+        frames = extract_frames_to_memory(video_path, FPS, crop)
+    else:
+        frames = extract_frames(video_path, out_dir, fps=FPS, crop=crop)
+    if not frames:
+        return []
+
+    # Sample up to max_frames evenly across the video
+    num_frames_to_use = min(max_frames, len(frames))
+    indices = np.linspace(0, len(frames) - 1, num_frames_to_use, dtype=int)
+    return [(fit_frame_budget(frames[i]), i / float(FPS)) for i in indices]
+
+
+def frame_label(frame: Frame, timestamp_sec: float) -> str:
+    """Human-readable name for a frame, used for frame_file and logs."""
+    if isinstance(frame, bytes):
+        return f"frame@{timestamp_sec:.2f}s"
+    return str(frame)
+
+
+def _frame_bytes(frame: Frame) -> bytes:
+    if isinstance(frame, bytes):
+        return frame
+    with open(frame, "rb") as f:
+        return f.read()
+
+
+def encode_image_to_data_url(frame: Frame) -> str:
+    b64 = base64.b64encode(_frame_bytes(frame)).decode("utf-8")
     # jpeg is fine for our ffmpeg output
     return f"data:image/jpeg;base64,{b64}"
 
 
-def chat_with_retry(model: str, messages: List[Dict], **kwargs):
+def image_detail(size: Optional[Tuple[int, int]]) -> str:
+    """
+    The detail level to send an image of `size` at. With IMAGE_DETAIL "auto",
+    images that fit in one tile go as "low": the model sees them at 512px either way.
     """
-    Call OpenAI with basic exponential backoff on rate limits.
+    if IMAGE_DETAIL in ("low", "high"):
+        return IMAGE_DETAIL
+    if size is not None and max(size) <= IMAGE_TILE_SIZE:
+        return "low"
+    return "high"
+
+
+def image_part(frame: Frame) -> Dict:
+    """The image_url content part for a frame, at the detail level image_detail picks."""
+    data = _frame_bytes(frame)
+    b64 = base64.b64encode(data).decode("utf-8")
+    return {
+        "type": "image_url",
+        "image_url": {"url": f"data:image/jpeg;base64,{b64}", "detail": image_detail(jpeg_size(data))},
+    }
+
+
+def _check_cancel(cancel: Optional[threading.Event]) -> None:
+    if cancel is not None and cancel.is_set():
+        raise PipelineError("Job cancelled", 499)
+
+
+def chat_with_retry(
+    model: str,
+    messages: List[Dict],
+    purpose: str = "chat",
+    cancel: Optional[threading.Event] = None,
+    **kwargs,
+):
     """
+    Call OpenAI through the shared rate governor, with jittered exponential
+    backoff (or the server's retry-after) if a rate limit is still hit.
+    Latency, token usage and retries are recorded under `purpose`.
+    Once cancel is set, raises PipelineError(499) instead of sending the request,
+    checked before every attempt and again after the governor's wait.
+    """
+    estimated_tokens = estimate_request_tokens(messages, kwargs.get("max_tokens"), model)
     last_err = None
     for attempt in range(1, MAX_RETRIES + 1):
+        _check_cancel(cancel)
+        rate_governor_acquire(model, estimated_tokens)
+        _check_cancel(cancel)
+        start = time.monotonic()
         try:
-            return client.chat.completions.create(
+            # The SDK's own retries would hide 429s and their headers from the governor
+            raw = get_openai_client().with_options(max_retries=0).chat.completions.with_raw_response.create(
                 model=model,
                 messages=messages,
                 **kwargs,
             )
+            resp = raw.parse()
+            rate_governor_observe(model, raw.headers)
+            record_openai_call(model, purpose, time.monotonic() - start, getattr(resp, "usage", None))
+            return resp
         except Exception as e:
             last_err = e
             msg = str(e).lower()
-            is_rate = "rate limit" in msg or "429" in msg or "tpm" in msg
-            if is_rate and attempt < MAX_RETRIES:
-                delay = RETRY_BASE_DELAY * (2 ** (attempt - 1))
-                print(f"⚠️ OpenAI rate limit (attempt {attempt}/{MAX_RETRIES}), retrying in {delay:.2f}s")
+            status_code = getattr(e, "status_code", None)
+            is_rate = status_code == 429 or "rate limit" in msg or "429" in msg or "tpm" in msg
+            is_transient = isinstance(e, APIConnectionError) or (status_code or 0) >= 500
+            if is_transient and attempt < MAX_RETRIES:
+                delay = RETRY_BASE_DELAY * (2 ** (attempt - 1)) * random.uniform(0.5, 1)
+                print(f"⚠️ OpenAI error (attempt {attempt}/{MAX_RETRIES}): {e}, retrying in {delay:.2f}s")
                 time.sleep(delay)
                 continue
+            if is_rate and attempt < MAX_RETRIES:
+                metric_inc("skillcam_openai_rate_limited_total", model=model)
+                headers = getattr(getattr(e, "response", None), "headers", None) or {}
+                retry_after = rate_governor_observe(model, headers)
+                if retry_after is None:
+                    backoff = RETRY_BASE_DELAY * (2 ** (attempt - 1))
+                    retry_after = backoff / 2 + random.uniform(0, backoff / 2)
+                print(f"⚠️ OpenAI rate limit (attempt {attempt}/{MAX_RETRIES}), retrying in {retry_after:.2f}s")
+                record_openai_retry(model, retry_after)
+                time.sleep(retry_after)
+                continue
             print(f"❌ OpenAI error (attempt {attempt}): {e}")
+            metric_inc("skillcam_openai_errors_total", model=model)
             raise e
     raise last_err
 
 
-def analyze_frame_with_gpt(frame_path: Path, timestamp_sec: float) -> Dict:
-    """
-    Send a single frame to a vision-capable GPT model.
-    Ask it to return a JSON blob describing that moment in the video.
-    """
-    image_url = encode_image_to_data_url(frame_path)
-
-    prompt = f"""
-You are analyzing a single frame from a vocational training video.
+FRAME_GUIDANCE = """
 If the frame shows a screw tightening task (screwdriver, drill/driver, etc.), give a skill_score around 83 unless clear evidence warrants lower/higher. Focus on what needs improvement: alignment/angle, grip stability, drive speed/pressure, workpiece support, bit/screw positioning, and safety. Add gloves as a safety concern. If the technique looks fine, say so briefly. Keep feedback concise—avoid filler. Do NOT give any feedback about wearing goggles/eye protection.
+""".strip()
 
+FRAME_PROMPT_TEMPLATE = """
+You are analyzing a single frame from a vocational training video.
+""".strip() + "\n" + FRAME_GUIDANCE + "\n\n" + """
 Return a *JSON object only* with the following keys:
 
 - "timestamp": float, seconds from the start of the video ({timestamp_sec})
@@ -164,299 +839,2648 @@ Return a *JSON object only* with the following keys:
 Do not include any explanation outside of JSON.
 """.strip()
 
-    resp = chat_with_retry(
-        model=VISION_MODEL,
-        messages=[
+BATCH_FRAME_PROMPT_TEMPLATE = """
+You are analyzing {count} frames from a vocational training video. Each image is preceded by its timestamp. Judge every frame on its own.
+""".strip() + "\n" + FRAME_GUIDANCE + "\n\n" + """
+Return a *JSON object only* with a single key "frames": an array with exactly {count} objects, one per image in the order given, each with the following keys:
+
+- "timestamp": float, the timestamp given for that image
+- "description": short natural language description of what the trainee is doing
+- "errors": list of strings (specific mistakes or technique issues)
+- "safety_issues": list of strings (any safety concerns)
+- "skill_score": integer between 0 and 100 estimating how well this step is executed
+
+Do not include any explanation outside of JSON.
+""".strip()
+
+
+def _message_text(resp) -> str:
+    raw = resp.choices[0].message.content
+
+    # content can be a string or a list of parts; handle both
+    if isinstance(raw, list):
+        return "".join(part.get("text", "") for part in raw if isinstance(part, dict))
+    return raw or ""
+
+
+FRAME_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "timestamp": {"type": "number"},
+        "description": {"type": "string"},
+        "errors": {"type": "array", "items": {"type": "string"}},
+        "safety_issues": {"type": "array", "items": {"type": "string"}},
+        "skill_score": {"type": "integer"},
+    },
+    "required": ["timestamp", "description", "errors", "safety_issues", "skill_score"],
+    "additionalProperties": False,
+}
+
+BATCH_FRAME_SCHEMA = {
+    "type": "object",
+    "properties": {"frames": {"type": "array", "items": FRAME_SCHEMA}},
+    "required": ["frames"],
+    "additionalProperties": False,
+}
+
+STRUCTURED_RETRY_PROMPT = (
+    "Your reply could not be parsed ({error}). "
+    "Reply again with only the JSON object, in the format asked for above."
+)
+
+_JSON_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)\s*```", re.DOTALL | re.IGNORECASE)
+_JSON_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+_JSON_LITERALS_RE = re.compile(r"\b(true|false|null)\b")
+_PYTHON_LITERALS = {"true": "True", "false": "False", "null": "None"}
+
+
+def json_response_format(name: str, schema: Dict) -> Dict:
+    """response_format for a reply shaped like `schema` (strict), or JSON mode without STRUCTURED_OUTPUTS."""
+    if not STRUCTURED_OUTPUTS:
+        return {"type": "json_object"}
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+
+def _json_span(text: str) -> Optional[str]:
+    """The first balanced {...} or [...] in text, ignoring brackets inside quoted strings."""
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if not starts:
+        return None
+    start = min(starts)
+    depth = 0
+    quote = None
+    escaped = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if quote:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == quote:
+                quote = None
+        elif c in "\"'":
+            quote = c
+        elif c in "{[":
+            depth += 1
+        elif c in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[start : i + 1]
+    return None
+
+
+def repair_json(text: str) -> Tuple[object, bool]:
+    """
+    Parse a model reply as JSON, repairing what models commonly get wrong:
+    code fences, prose before or after the object, trailing commas and
+    single-quoted (Python-style) literals.
+    Returns (value, whether it needed repair). Raises ValueError if nothing parses.
+    """
+    try:
+        return json.loads(text), False
+    except ValueError:
+        pass
+
+    candidate = text
+    fence = _JSON_FENCE_RE.search(candidate)
+    if fence:
+        candidate = fence.group(1)
+    candidate = _json_span(candidate) or candidate.strip()
+    candidate = _JSON_TRAILING_COMMA_RE.sub(r"\1", candidate)
+    try:
+        return json.loads(candidate), True
+    except ValueError as e:
+        error = e
+
+    # Single quotes: read it as a Python literal, with JSON's true/false/null spelled the Python way
+    python_literals = _JSON_LITERALS_RE.sub(lambda m: _PYTHON_LITERALS[m.group(1)], candidate)
+    for attempt in (candidate, python_literals):
+        try:
+            value = ast.literal_eval(attempt)
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            continue
+        if isinstance(value, (dict, list)):
+            return value, True
+    raise ValueError(f"not JSON: {error}")
+
+
+def parse_json_reply(raw_text: str, purpose: str) -> object:
+    """repair_json, with the outcome counted under `purpose` (see record_structured_output)."""
+    try:
+        value, repaired = repair_json(raw_text)
+    except ValueError:
+        record_structured_output(purpose, "unparseable")
+        raise
+    record_structured_output(purpose, "repaired" if repaired else "parsed")
+    return value
+
+
+def structured_reply(
+    request: Dict,
+    raw_text: str,
+    purpose: str,
+    validate: Callable[[object], object],
+    cancel: Optional[threading.Event] = None,
+) -> object:
+    """
+    Parse a reply to `request` (repair_json) and check it with `validate`, which
+    raises ValueError for a value of the wrong shape. A reply that still fails
+    gets up to STRUCTURED_OUTPUT_RETRIES follow-ups that quote it back and name
+    the problem. Raises ValueError once those are used up.
+    """
+    attempt = 0
+    while True:
+        try:
+            return validate(parse_json_reply(raw_text, purpose))
+        except ValueError as e:
+            error = e
+        if attempt >= STRUCTURED_OUTPUT_RETRIES:
+            record_structured_output(purpose, "fallback")
+            raise ValueError(f"unparseable {purpose} reply: {error}")
+        attempt += 1
+        record_structured_output(purpose, "retried")
+        print(f"⚠️ Unparseable {purpose} reply ({error}), asking again ({attempt}/{STRUCTURED_OUTPUT_RETRIES})")
+        messages = request["messages"] + [
+            {"role": "assistant", "content": raw_text},
+            {"role": "user", "content": STRUCTURED_RETRY_PROMPT.format(error=error)},
+        ]
+        resp = chat_with_retry(purpose=purpose, cancel=cancel, **{**request, "messages": messages})
+        raw_text = _message_text(resp)
+
+
+def structured_chat(
+    request: Dict,
+    purpose: str,
+    validate: Callable[[object], object],
+    cancel: Optional[threading.Event] = None,
+) -> object:
+    """Send `request` through chat_with_retry and return its validated JSON reply (see structured_reply)."""
+    resp = chat_with_retry(purpose=purpose, cancel=cancel, **request)
+    return structured_reply(request, _message_text(resp), purpose, validate, cancel)
+
+
+def frame_request(frame: Frame, timestamp_sec: float) -> Dict:
+    """Chat completion arguments (model, messages, max_tokens, response_format) for one frame."""
+    prompt = FRAME_PROMPT_TEMPLATE.format(timestamp_sec=timestamp_sec)
+
+    return {
+        "model": VISION_MODEL,
+        "messages": [
             {
                 "role": "user",
                 "content": [
                     {"type": "text", "text": prompt},
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": image_url},
-                    },
+                    image_part(frame),
                 ],
             }
         ],
-        max_tokens=500,
-    )
-
-    raw = resp.choices[0].message.content
+        "max_tokens": 500,
+        "response_format": json_response_format("frame_analysis", FRAME_SCHEMA),
+    }
 
-    # content can be a string or a list of parts; handle both
-    if isinstance(raw, list):
-        raw_text = "".join(part.get("text", "") for part in raw if isinstance(part, dict))
-    else:
-        raw_text = raw or ""
 
+def validate_frame_analysis(data: object, timestamp_sec: float) -> Dict:
+    """
+    Check a parsed frame reply: an object with a numeric skill_score. Sets the
+    requested timestamp and fills in empty issue lists if they are missing.
+    Raises ValueError otherwise.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("frame reply is not an object")
     try:
-        data = json.loads(raw_text)
-    except Exception:
-        # Fallback: wrap whatever we got
-        data = {
-            "timestamp": timestamp_sec,
-            "description": raw_text.strip(),
-            "errors": [],
-            "safety_issues": [],
-            "skill_score": 0,
-        }
-
-    # Guarantee timestamp exists
-    if "timestamp" not in data:
-        data["timestamp"] = timestamp_sec
-
+        data["skill_score"] = int(round(float(data["skill_score"])))
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("frame reply has no numeric skill_score")
+
+    # The frame we asked about, whatever the model echoed
+    data["timestamp"] = timestamp_sec
+    data.setdefault("errors", [])
+    data.setdefault("safety_issues", [])
     return data
 
 
-def global_analysis_with_gpt(frame_analyses: List[Dict]) -> Dict:
+def analyze_frame_with_gpt(frame: Frame, timestamp_sec: float, cancel: Optional[threading.Event] = None) -> Dict:
     """
-    Send all per-frame JSONs to a text model for a global summary.
-    Returns a dictionary with structured metrics and feedback.
+    Send a single frame to a vision-capable GPT model.
+    Ask it to return a JSON blob describing that moment in the video.
+    Raises ValueError if no usable analysis comes back (see structured_reply).
     """
-    system_msg = (
-        "You are an expert vocational trainer. "
-        "You give precise, structured, and encouraging feedback. "
-        "You must return valid JSON only, no additional text."
+    return structured_chat(
+        frame_request(frame, timestamp_sec),
+        "vision",
+        lambda data: validate_frame_analysis(data, timestamp_sec),
+        cancel,
     )
 
-    user_prompt = """
-You are given JSON analyses for several frames from a trainee's task video.
 
-Analyze the frame data and return a JSON object with the following structure:
+def analyze_frame_batch_with_gpt(
+    items: List[Tuple[Frame, float]], cancel: Optional[threading.Event] = None
+) -> List[Dict]:
+    """
+    Send several frames, each tagged with its timestamp, in one request so the
+    instruction prompt is paid once. Returns one analysis per item, in order.
+    Raises ValueError if the reply can't be mapped back onto the frames, including
+    when an echoed timestamp doesn't match its position.
+    """
+    content = [{"type": "text", "text": BATCH_FRAME_PROMPT_TEMPLATE.format(count=len(items))}]
+    for frame, timestamp_sec in items:
+        content.append({"type": "text", "text": f"Frame at timestamp {timestamp_sec:.2f}s:"})
+        content.append(image_part(frame))
 
-{
-  "overallScore": <integer 0-100, overall performance score>,
-  "accuracy": <integer 0-100, how accurately the trainee performed the task>,
-  "stability": <integer 0-100, how stable and controlled the movements were>,
-  "toolUsage": <integer 0-100, how effectively the trainee used the tools>,
-  "completionTime": <string, estimated time to complete task in format like "2m 30s" or "N/A" if not applicable>,
-  "feedback": "<markdown text with: 1) Overall assessment (1-2 sentences), 2) Key strengths (bullet list), 3) Recurring mistakes (bullet list), 4) Safety issues (bullet list), 5) Next steps for practice (numbered list). Use clear markdown headings and bullets, but avoid using asterisks for emphasis - use plain text or bold markdown **text** only when necessary.>"
-}
+    resp = chat_with_retry(
+        model=VISION_MODEL,
+        purpose="vision_batch",
+        cancel=cancel,
+        messages=[{"role": "user", "content": content}],
+        max_tokens=500 * len(items),
+        response_format=json_response_format("frame_analyses", BATCH_FRAME_SCHEMA),
+    )
 
-Calculate the metrics based on:
-- overallScore: Average of skill_score from frames, adjusted for consistency
-- accuracy: Based on error frequency and precision of movements
-- stability: Based on consistency of skill_score across frames
-- toolUsage: Based on proper tool handling and technique
-- completionTime: Estimate from frame timestamps or "N/A"
+    # No follow-up request here: analyze_frames_batched splits the batch instead
+    try:
+        analyses = parse_json_reply(_message_text(resp), "vision_batch")["frames"]
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"unparseable batch reply: {e}")
+    if not isinstance(analyses, list) or len(analyses) != len(items):
+        raise ValueError(f"expected {len(items)} frame objects in batch reply")
+    # Replies map onto frames by position; a reordered or mislabelled one gets split instead
+    for a, (_, timestamp_sec) in zip(analyses, items):
+        echoed = a.get("timestamp") if isinstance(a, dict) else None
+        try:
+            matches = abs(float(echoed) - timestamp_sec) < 0.01
+        except (TypeError, ValueError):
+            matches = False
+        if not matches:
+            raise ValueError(f"batch reply has timestamp {echoed!r} where {timestamp_sec:.2f} was expected")
+    return [validate_frame_analysis(a, timestamp_sec) for a, (_, timestamp_sec) in zip(analyses, items)]
 
-Return ONLY the JSON object, no additional text or explanation.
-""".strip()
 
-    try:
-        resp = chat_with_retry(
-            model=SUMMARY_MODEL,
-            messages=[
-                {"role": "system", "content": system_msg},
-                {
-                    "role": "user",
-                    "content": user_prompt
-                    + "\n\nHere is the JSON data:\n\n"
-                    + json.dumps(frame_analyses, indent=2),
-                },
-            ],
-            max_tokens=1200,
-            response_format={"type": "json_object"},
-        )
-    except Exception as e:
-        # Fallback if JSON mode is not supported or rate-limited
-        print(f"JSON mode not supported or retry exhausted, falling back to text mode: {e}")
-        resp = chat_with_retry(
-            model=SUMMARY_MODEL,
-            messages=[
-                {"role": "system", "content": system_msg + " Return ONLY valid JSON, no additional text."},
-                {
-                    "role": "user",
-                    "content": user_prompt
-                    + "\n\nHere is the JSON data:\n\n"
-                    + json.dumps(frame_analyses, indent=2),
-                },
-            ],
-            max_tokens=1200,
-        )
+def analyze_frames_batched(
+    items: List[Tuple[Frame, float]], cancel: Optional[threading.Event] = None
+) -> List[Optional[Dict]]:
+    """
+    Analyze items with one batched request, splitting the batch in half and
+    retrying when the reply can't be parsed. Returns one entry per item, None
+    for a frame whose call failed. Raises PipelineError(499) once cancel is set.
+    """
+    if len(items) == 1:
+        frame, timestamp_sec = items[0]
+        try:
+            return [analyze_frame_with_gpt(frame, timestamp_sec, cancel)]
+        except PipelineError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Error analyzing frame {frame_label(frame, timestamp_sec)}: {e}")
+            return [None]
 
-    raw = resp.choices[0].message.content
-    
     try:
-        data = json.loads(raw)
-        
-        # Ensure all required fields exist with defaults
-        result = {
-            "overallScore": int(data.get("overallScore", 0)),
-            "accuracy": int(data.get("accuracy", 0)),
-            "stability": int(data.get("stability", 0)),
-            "toolUsage": int(data.get("toolUsage", 0)),
-            "completionTime": str(data.get("completionTime", "N/A")),
-            "feedback": str(data.get("feedback", "")),
-        }
-        
-        # Validate ranges
-        for key in ["overallScore", "accuracy", "stability", "toolUsage"]:
-            result[key] = max(0, min(100, result[key]))
-        
-        return result
+        return analyze_frame_batch_with_gpt(items, cancel)
+    except ValueError as e:
+        mid = len(items) // 2
+        print(f"⚠️ Batch of {len(items)} frames failed to parse ({e}), splitting into {mid} + {len(items) - mid}")
+        record_structured_output("vision_batch", "retried")
+        return analyze_frames_batched(items[:mid], cancel) + analyze_frames_batched(items[mid:], cancel)
+    except PipelineError:
+        raise
     except Exception as e:
-        print(f"Error parsing AI response: {e}")
-        print(f"Raw response: {raw}")
-        
-        # Fallback: calculate from frame analyses
-        skill_scores = [f.get("skill_score", 0) for f in frame_analyses if f.get("skill_score")]
-        avg_score = int(sum(skill_scores) / len(skill_scores)) if skill_scores else 0
-        
-        return {
-            "overallScore": avg_score,
-            "accuracy": avg_score,
-            "stability": avg_score,
-            "toolUsage": avg_score,
-            "completionTime": "N/A",
-            "feedback": raw if raw else "Analysis completed. Review the frame-by-frame details for specific feedback.",
-        }
+        print(f"⚠️ Error analyzing batch of {len(items)} frames: {e}")
+        return [None] * len(items)
 
 
-# ---------- routes ----------
+def analyze_frames(
+    selected: List[Tuple[Frame, float]],
+    cache_keys: Optional[List[Optional[str]]] = None,
+    on_result: Optional[Callable[[Optional[Dict]], None]] = None,
+    cancel: Optional[threading.Event] = None,
+) -> List[Optional[Dict]]:
+    """
+    Analyze (frame, timestamp_sec) pairs with at most FRAME_ANALYSIS_CONCURRENCY
+    requests in flight, each covering up to VISION_BATCH_SIZE frames.
+    Returns one entry per pair, in the same order (None for a failed frame).
+    on_result, if given, is called as each frame finishes.
+    cache_keys[i], if set, reads/writes selected[i] in the per-frame cache.
+    Once cancel is set, requests that haven't been sent are skipped and
+    PipelineError(499) is raised.
+    """
+    results: List[Optional[Dict]] = [None] * len(selected)
+    cache_keys = cache_keys or [None] * len(selected)
+
+    def _finish(i: int, analysis: Optional[Dict]) -> None:
+        if analysis is not None:
+            analysis["frame_file"] = frame_label(*selected[i])
+        results[i] = analysis
+        if on_result:
+            on_result(analysis)
+
+    pending = []
+    for i, cache_key in enumerate(cache_keys):
+        cached = cache_get("frame", cache_key) if cache_key else None
+        if cached is not None:
+            _finish(i, cached)
+        else:
+            pending.append(i)
+
+    def _analyze(batch: List[int]) -> None:
+        analyses = analyze_frames_batched([selected[i] for i in batch], cancel)
+        for i, analysis in zip(batch, analyses):
+            if analysis is not None and cache_keys[i]:
+                cache_put("frame", cache_keys[i], analysis)
+            _finish(i, analysis)
+
+    batches = [pending[n : n + VISION_BATCH_SIZE] for n in range(0, len(pending), VISION_BATCH_SIZE)]
+    if batches:
+        workers = min(FRAME_ANALYSIS_CONCURRENCY, len(batches))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="frame-analysis") as pool:
+            map_in_context(pool, _analyze, batches)
+
+    return results
+
+
+def analyze_frames_concurrently(
+    selected: List[Tuple[Frame, float]],
+    on_result: Optional[Callable[[Optional[Dict]], None]] = None,
+    content_hash: Optional[str] = None,
+    cancel: Optional[threading.Event] = None,
+) -> List[Dict]:
+    """
+    analyze_frames for one video: failed frames are skipped and results come
+    back in timestamp order. With content_hash, the per-frame cache is used.
+    """
+    if not selected:
+        return []
+    cache_keys = [frame_cache_key(content_hash, ts) if content_hash else None for _, ts in selected]
+    results = analyze_frames(selected, cache_keys, on_result, cancel)
+    # results is indexed like selected, which is timestamp order
+    return [r for r in results if r is not None]
 
 
-@app.route("/")
-def health():
-    return jsonify({"status": "ok"})
+def frames_agree(a: Dict, b: Dict) -> bool:
+    """
+    Whether two frame analyses tell the same story: skill_scores within
+    ADAPTIVE_SCORE_SPREAD, and for errors and safety_issues alike, both frames
+    either have none or have counts within ADAPTIVE_ISSUE_SPREAD. The wording
+    of the issues is ignored; independent replies rarely phrase them alike.
+    """
+    if abs(float(a.get("skill_score") or 0) - float(b.get("skill_score") or 0)) > ADAPTIVE_SCORE_SPREAD:
+        return False
+    for key in ("errors", "safety_issues"):
+        count_a, count_b = len(_as_list(a.get(key))), len(_as_list(b.get(key)))
+        if (count_a == 0) != (count_b == 0) or abs(count_a - count_b) > ADAPTIVE_ISSUE_SPREAD:
+            return False
+    return True
 
 
-def download_video_from_supabase(bucket: str, storage_path: str, local_path: Path) -> bool:
-    """Download video from Supabase Storage to local path"""
-    try:
-        # Ensure we don't pass the bucket name twice
-        if storage_path.startswith(f"{bucket}/"):
-            storage_path = storage_path[len(bucket)+1 :]
+def analyze_adaptively(
+    video_path: Path,
+    frames_dir: Optional[Path],
+    coarse: List[Tuple[Frame, float]],
+    content_hash: Optional[str],
+    progress: "JobProgress",
+    crop: Optional[CropBox] = None,
+) -> Tuple[List[Dict], Dict]:
+    """
+    Coarse-to-fine analysis for FRAME_SELECTION_MODE "adaptive":
+    - analyze the coarse frames (evenly spaced on the FPS grid, both ends included)
+    - between every two neighbouring samples that don't agree (frames_agree) and
+      are at least twice as far apart as "linspace" would space MAX_FRAMES_TO_ANALYZE
+      frames, extract and analyze the frame halfway between them, biggest score
+      gaps first; no new gap ends up closer than that spacing
+    - repeat until no such pair is left or ADAPTIVE_MAX_FRAMES frames have been tried
+    Added frames are cropped to `crop` like the coarse ones.
+    Returns (frame analyses in timestamp order, sampling summary for the payload).
+    """
+    analyses: Dict[int, Dict] = {}  # FPS-grid slot -> analysis
+    tried = set()
+    failed = 0
+    pending = coarse
+    rounds = 0
+    # A disputed window is split only while both halves stay as wide as fixed sampling's spacing
+    last_slot = max((int(round(ts * FPS)) for _, ts in coarse), default=0)
+    min_gap = max(1.0, last_slot / max(1, MAX_FRAMES_TO_ANALYZE - 1))
+
+    def _score(slot: int) -> float:
+        return float(analyses[slot].get("skill_score") or 0)
+
+    while pending:
+        rounds += 1
+        cache_keys = [frame_cache_key(content_hash, ts) if content_hash else None for _, ts in pending]
+        results = analyze_frames(pending, cache_keys, progress.frame_done, progress.cancel_event)
+        progress.check_cancelled()
+        for (_, timestamp_sec), analysis in zip(pending, results):
+            slot = int(round(timestamp_sec * FPS))
+            tried.add(slot)
+            if analysis is not None:
+                analyses[slot] = analysis
+            else:
+                failed += 1
+
+        slots = sorted(analyses)
+        disputed = [
+            (a, b) for a, b in zip(slots, slots[1:])
+            if b - a >= 2 * min_gap and not frames_agree(analyses[a], analyses[b])
+        ]
+        disputed.sort(key=lambda pair: abs(_score(pair[0]) - _score(pair[1])), reverse=True)
+        midpoints = [m for m in dict.fromkeys((a + b) // 2 for a, b in disputed) if m not in tried]
+        midpoints = sorted(midpoints[: max(0, ADAPTIVE_MAX_FRAMES - len(tried))])
+        if not midpoints:
+            break
+
+        pending = extract_frames_at(
+            video_path, frames_dir, [m / FPS for m in midpoints], first_index=len(tried), crop=crop
+        )
+        tried.update(midpoints)
+        progress.frames_added(len(pending))
+
+    slots = sorted(analyses)
+    unresolved = [(a, b) for a, b in zip(slots, slots[1:]) if not frames_agree(analyses[a], analyses[b])]
+    if not unresolved:
+        stopped = "agreement"
+    elif any(b - a >= 2 * min_gap for a, b in unresolved):
+        stopped = "ceiling"
+    else:
+        stopped = "resolution"
 
-        # Get signed URL (valid for 1 hour)
-        response = supabase.storage.from_(bucket).create_signed_url(storage_path, 3600)
+    sampling = {
+        "mode": "adaptive",
+        "frames": len(analyses),
+        "frames_failed": failed,
+        "coarse_frames": len(coarse),
+        "rounds": rounds,
+        "stopped": stopped,
+    }
+    return [analyses[slot] for slot in slots], sampling
 
-        if not response or "signedURL" not in response:
-            print(f"Failed to get signed URL for {storage_path}")
-            return False
 
-        signed_url = response["signedURL"]
+# Bump when compute_local_metrics changes so cached results are recomputed
+LOCAL_SCORING_VERSION = 2
 
-        # Download the file
-        file_response = requests.get(signed_url, timeout=60)
-        file_response.raise_for_status()
+TOOL_ERROR_KEYWORDS = (
+    "tool", "driver", "screwdriver", "drill", "bit", "screw", "grip", "angle",
+    "alignment", "pressure", "torque", "speed",
+)
 
-        # Save to local path
-        with open(local_path, "wb") as f:
-            f.write(file_response.content)
 
-        print(f"✅ Downloaded video from Supabase: {storage_path} -> {local_path}")
-        return True
-    except Exception as e:
-        print(f"❌ Error downloading video: {e}")
-        return False
+def _as_list(value) -> List:
+    return value if isinstance(value, list) else []
 
 
-@app.route("/upload", methods=["POST"])
-def upload():
-    """
-    Accepts JSON with 'videoPath' pointing to a video in Supabase Storage.
-    - Downloads video from Supabase
-    - Extracts frames with ffmpeg
-    - Runs GPT per-frame analysis
-    - Runs GPT global summary
-    - Returns JSON:
+def format_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    minutes, secs = divmod(seconds, 60)
+    return f"{minutes}m {secs}s" if minutes else f"{secs}s"
 
-      {
-        "job_id": str,
-        "video_filename": str,
-        "frame_analyses": [...],
-        "final_summary": str
-      }
+
+def compute_local_metrics(frame_analyses: List[Dict]) -> Dict:
     """
-    job_id = None
-    video_path = None
-    frames_dir = None
-    
-    try:
-        data = request.get_json()
+    Score a job from the per-frame analyses, deterministically and without a model call.
+    - overallScore: mean skill_score minus a penalty for spread across frames
+    - accuracy: mean skill_score blended with an error-frequency score
+    - stability: penalizes spread and frame-to-frame jumps in skill_score
+    - toolUsage: mean skill_score blended with a score for tool/technique errors
+    - completionTime: span of the analyzed timestamps
+    """
+    frames = sorted(frame_analyses, key=lambda f: float(f.get("timestamp") or 0))
+    if not frames:
+        metrics = {key: 0 for key in ("overallScore", "accuracy", "stability", "toolUsage")}
+        metrics["completionTime"] = "N/A"
+        return metrics
+
+    scores = np.clip(np.array([float(f.get("skill_score") or 0) for f in frames]), 0, 100)
+    errors = [_as_list(f.get("errors")) for f in frames]
+    error_counts = np.array([len(e) for e in errors], dtype=float)
+    tool_error_counts = np.array(
+        [sum(any(k in str(err).lower() for k in TOOL_ERROR_KEYWORDS) for err in e) for e in errors],
+        dtype=float,
+    )
+    timestamps = np.array([float(f.get("timestamp") or 0) for f in frames])
+
+    mean_score = scores.mean()
+    spread = scores.std()
+    mean_step = np.abs(np.diff(scores)).mean() if len(scores) > 1 else 0.0
+
+    metrics = {
+        "overallScore": mean_score - 0.5 * spread,
+        "accuracy": 0.5 * mean_score + 0.5 * np.clip(100 - 12 * error_counts, 0, 100).mean(),
+        "stability": 100 - 1.5 * spread - mean_step,
+        "toolUsage": 0.5 * mean_score + 0.5 * np.clip(100 - 15 * tool_error_counts, 0, 100).mean(),
+    }
+    metrics = {key: int(round(np.clip(value, 0, 100))) for key, value in metrics.items()}
+
+    span = timestamps.max() - timestamps.min() if len(timestamps) > 1 else 0.0
+    metrics["completionTime"] = format_duration(span) if span > 0 else "N/A"
+    return metrics
+
+
+def compact_frame_data(frame_analyses: List[Dict]) -> str:
+    """Minified per-frame data for the summary prompt (no frame_file paths or whitespace)."""
+    compact = [
+        {
+            "t": f.get("timestamp"),
+            "score": f.get("skill_score"),
+            "desc": f.get("description", ""),
+            "errors": _as_list(f.get("errors")),
+            "safety": _as_list(f.get("safety_issues")),
+        }
+        for f in frame_analyses
+    ]
+    return json.dumps(compact, separators=(",", ":"), ensure_ascii=False)
+
+
+def fallback_feedback(frame_analyses: List[Dict]) -> str:
+    """Feedback assembled locally when the summary call fails."""
+    def _recurring(key: str) -> List[str]:
+        seen: Dict[str, None] = {}
+        for f in frame_analyses:
+            for item in _as_list(f.get(key)):
+                seen.setdefault(str(item), None)
+        return list(seen)[:5]
+
+    lines = ["## Overall assessment", "Analysis completed. Review the frame-by-frame details for specific feedback."]
+    mistakes = _recurring("errors")
+    if mistakes:
+        lines += ["", "## Recurring mistakes"] + [f"- {m}" for m in mistakes]
+    safety = _recurring("safety_issues")
+    if safety:
+        lines += ["", "## Safety issues"] + [f"- {s}" for s in safety]
+    return "\n".join(lines)
+
+
+SUMMARY_SYSTEM_MSG = (
+    "You are an expert vocational trainer. "
+    "You give precise, structured, and encouraging feedback."
+)
 
-        if not data or "videoPath" not in data:
-            return jsonify({"error": "No 'videoPath' in request"}), 400
+SUMMARY_PROMPT = """
+You are given compact JSON for several frames from a trainee's task video ("t": seconds from the start, "score": skill score 0-100, "desc": what the trainee is doing, "errors": technique issues, "safety": safety concerns), and the metrics already computed from them.
 
-        storage_path = data["videoPath"]
-        job_id = str(uuid.uuid4())
-        ext = Path(storage_path).suffix or ".mp4"
-        video_path = UPLOAD_FOLDER / f"{job_id}{ext}"
+Write the trainee's feedback as markdown with: 1) Overall assessment (1-2 sentences), 2) Key strengths (bullet list), 3) Recurring mistakes (bullet list), 4) Safety issues (bullet list), 5) Next steps for practice (numbered list). Use clear markdown headings and bullets, but avoid using asterisks for emphasis - use plain text or bold markdown **text** only when necessary. Do not restate the metric numbers.
+""".strip()
 
-        # Download video from Supabase
-        bucket = data.get("bucket") or "submission-videos"
-        print(f"🎬 Downloading video from Supabase: {bucket}/{storage_path}")
-        if not download_video_from_supabase(bucket, storage_path, video_path):
-            return jsonify({"error": "Failed to download video from storage"}), 500
+SUMMARY_JSON_INSTRUCTION = 'Return a JSON object {"feedback": "<markdown>"} and nothing else.'
+SUMMARY_SCHEMA = {
+    "type": "object",
+    "properties": {"feedback": {"type": "string"}},
+    "required": ["feedback"],
+    "additionalProperties": False,
+}
+SUMMARY_STREAM_INSTRUCTION = "Return only the markdown, no preamble."
 
-        print(f"✅ Video downloaded: {video_path}")
 
-        # Extract frames
-        frames_dir = FRAMES_FOLDER / job_id
-        try:
-            frames = extract_frames(video_path, frames_dir, fps=FPS)
-        except subprocess.CalledProcessError as e:
-            print(f"❌ ffmpeg failed: {e}")
-            return jsonify({"error": f"ffmpeg failed: {e}"}), 500
-
-        if not frames:
-            return jsonify({"error": "No frames extracted from video"}), 500
-
-        # Sample up to MAX_FRAMES_TO_ANALYZE evenly across the video
-        num_frames_to_use = min(MAX_FRAMES_TO_ANALYZE, len(frames))
-        indices = np.linspace(0, len(frames) - 1, num_frames_to_use, dtype=int)
-        selected = [(frames[i], i) for i in indices]
-
-        frame_analyses: List[Dict] = []
-        for frame_path, frame_idx in selected:
-            timestamp_sec = frame_idx / float(FPS)
+def global_analysis_with_gpt(
+    frame_analyses: List[Dict],
+    on_delta: Optional[Callable[[str], None]] = None,
+    cancel: Optional[threading.Event] = None,
+) -> Dict:
+    """
+    Compute the metrics locally (compute_local_metrics) and ask a text model only
+    for the feedback markdown. With SUMMARY_STREAM the feedback is streamed and
+    on_delta, if given, receives each text fragment as it arrives.
+    Returns a dictionary with structured metrics and feedback; "feedback_fallback"
+    is True when the model gave no feedback and fallback_feedback was used.
+    """
+    metrics = compute_local_metrics(frame_analyses)
+    user_content = (
+        SUMMARY_PROMPT
+        + "\n\n"
+        + (SUMMARY_STREAM_INSTRUCTION if SUMMARY_STREAM else SUMMARY_JSON_INSTRUCTION)
+        + "\n\nMetrics: "
+        + json.dumps(metrics, separators=(",", ":"))
+        + "\nFrames: "
+        + compact_frame_data(frame_analyses)
+    )
+    messages = [
+        {"role": "system", "content": SUMMARY_SYSTEM_MSG},
+        {"role": "user", "content": user_content},
+    ]
+
+    feedback = ""
+    try:
+        if SUMMARY_STREAM:
+            feedback = _stream_feedback(messages, on_delta, cancel)
+        else:
+            request = {
+                "model": SUMMARY_MODEL,
+                "messages": messages,
+                "max_tokens": 900,
+                "response_format": json_response_format("summary_feedback", SUMMARY_SCHEMA),
+            }
+            feedback = structured_chat(request, "summary", _validate_feedback, cancel)
+    except PipelineError:
+        raise
+    except Exception as e:
+        # No fresh request: the metrics are already local, only the prose is missing
+        print(f"❌ Summary call failed, using locally assembled feedback: {e}")
+
+    feedback = feedback.strip()
+    return {
+        **metrics,
+        "feedback": feedback or fallback_feedback(frame_analyses),
+        "feedback_fallback": not feedback,
+    }
+
+
+def _validate_feedback(data: object) -> str:
+    if not isinstance(data, dict) or not isinstance(data.get("feedback"), str) or not data["feedback"].strip():
+        raise ValueError("summary reply has no feedback")
+    return data["feedback"]
+
+
+def _stream_feedback(
+    messages: List[Dict],
+    on_delta: Optional[Callable[[str], None]],
+    cancel: Optional[threading.Event] = None,
+) -> str:
+    stream = chat_with_retry(
+        model=SUMMARY_MODEL,
+        purpose="summary",
+        cancel=cancel,
+        messages=messages,
+        max_tokens=900,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    parts = []
+    for chunk in stream:
+        if getattr(chunk, "usage", None):
+            record_openai_usage(SUMMARY_MODEL, chunk.usage)
+        if not chunk.choices:
+            continue
+        text = chunk.choices[0].delta.content or ""
+        if text:
+            parts.append(text)
+            if on_delta:
+                on_delta(text)
+    return "".join(parts)
+
+
+def stream_download(url: str, local_path: Path) -> Dict:
+    """
+    Stream url to local_path in DOWNLOAD_CHUNK_SIZE chunks so memory stays flat
+    regardless of video size. A dropped connection resumes with a Range request
+    (up to DOWNLOAD_MAX_RESUMES times).
+    Returns {"bytes", "seconds", "bytes_per_sec", "resumes", "sha256"}.
+    """
+    hasher = hashlib.sha256()
+    written = 0
+    resumes = 0
+    start = time.monotonic()
+
+    local_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(local_path, "wb") as f:
+        while True:
+            headers = {"Range": f"bytes={written}-"} if written else {}
             try:
-                analysis = analyze_frame_with_gpt(frame_path, timestamp_sec)
-                analysis["frame_file"] = str(frame_path)
-                frame_analyses.append(analysis)
+                with get_http_session().get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers) as resp:
+                    if written and resp.status_code == 416:
+                        # Connection dropped right after the last byte
+                        break
+                    resp.raise_for_status()
+                    if written and resp.status_code != 206:
+                        # Server ignored the Range header; start over
+                        f.seek(0)
+                        f.truncate()
+                        hasher = hashlib.sha256()
+                        written = 0
+                    for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        hasher.update(chunk)
+                        written += len(chunk)
+                break
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout,
+            ) as e:
+                resumes += 1
+                if resumes > DOWNLOAD_MAX_RESUMES:
+                    raise
+                print(f"⚠️ Download interrupted at {written} bytes, resuming ({resumes}/{DOWNLOAD_MAX_RESUMES}): {e}")
+
+    seconds = time.monotonic() - start
+    return {
+        "bytes": written,
+        "seconds": round(seconds, 3),
+        "bytes_per_sec": round(written / seconds) if seconds > 0 else None,
+        "resumes": resumes,
+        "sha256": hasher.hexdigest(),
+    }
+
+
+def create_signed_video_url(bucket: str, storage_path: str) -> Optional[str]:
+    """Get a signed URL (valid for 1 hour) for a video in Supabase Storage."""
+    # Ensure we don't pass the bucket name twice
+    if storage_path.startswith(f"{bucket}/"):
+        storage_path = storage_path[len(bucket)+1 :]
+
+    response = get_supabase().storage.from_(bucket).create_signed_url(storage_path, 3600)
+
+    if not response or "signedURL" not in response:
+        print(f"Failed to get signed URL for {storage_path}")
+        return None
+
+    return response["signedURL"]
+
+
+def probe_source_key(signed_url: str, bucket: str, storage_path: str) -> Optional[str]:
+    """
+    Identify the stored object version without downloading it, from the ETag and
+    size a HEAD request returns. Used to map a repeat request to a cached result.
+    """
+    try:
+        resp = get_http_session().head(signed_url, timeout=DOWNLOAD_TIMEOUT, allow_redirects=True)
+        resp.raise_for_status()
+    except Exception as e:
+        print(f"⚠️ HEAD on signed URL failed, skipping cache fast path: {e}")
+        return None
+
+    etag = resp.headers.get("ETag")
+    if not etag:
+        return None
+    return f"{bucket}/{storage_path}|{etag}|{resp.headers.get('Content-Length', '')}"
+
+
+def download_video_from_supabase(
+    bucket: str, storage_path: str, local_path: Path, signed_url: Optional[str] = None
+) -> Optional[Dict]:
+    """
+    Download video from Supabase Storage to local path.
+    Returns the stream_download stats, or None on failure.
+    """
+    try:
+        signed_url = signed_url or create_signed_video_url(bucket, storage_path)
+        if not signed_url:
+            return None
+
+        # Stream the file to disk
+        stats = stream_download(signed_url, local_path)
+
+        mb_per_sec = (stats["bytes_per_sec"] or 0) / (1024 * 1024)
+        print(
+            f"✅ Downloaded video from Supabase: {storage_path} -> {local_path} "
+            f"({stats['bytes']} bytes in {stats['seconds']}s, {mb_per_sec:.2f} MB/s)"
+        )
+        return stats
+    except Exception as e:
+        print(f"❌ Error downloading video: {e}")
+        return None
+
+
+class PipelineError(Exception):
+    """A pipeline failure that maps to an HTTP error response."""
+
+    def __init__(self, message: str, status_code: int = 500):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def run_analysis_pipeline(job_id: str, bucket: str, storage_path: str, progress: "JobProgress" = None) -> Dict:
+    """
+    Run the full analysis for one video and return the /upload response payload.
+    - Downloads video from Supabase
+    - Extracts frames with ffmpeg
+    - Runs GPT per-frame analysis
+    - Runs GPT global summary
+    The payload carries "timings" and "usage" blocks for this job.
+    Raises PipelineError for failures that should surface as HTTP errors.
+    """
+    progress = progress or JobProgress(job_id, persist=False)
+    telemetry = JobTelemetry()
+    token = _current_telemetry.set(telemetry)
+    ext = Path(storage_path).suffix or ".mp4"
+    video_path = UPLOAD_FOLDER / f"{job_id}{ext}"
+    frames_dir = FRAMES_FOLDER / job_id if FRAME_SOURCE == "disk" else None
+    outcome = "error"
+
+    try:
+        payload, outcome = _run_pipeline_stages(
+            job_id, bucket, storage_path, video_path, frames_dir, progress, telemetry
+        )
+    finally:
+        # Cleanup temporary files after processing
+        with telemetry.stage("cleanup"):
+            try:
+                if video_path and video_path.exists():
+                    video_path.unlink()
+                    print(f"🧹 Cleaned up video: {video_path}")
+                if frames_dir and frames_dir.exists():
+                    shutil.rmtree(frames_dir, ignore_errors=True)
+                    print(f"🧹 Cleaned up frames: {frames_dir}")
             except Exception as e:
-                print(f"⚠️ Error analyzing frame {frame_path}: {e}")
-                # Continue with other frames
+                print(f"⚠️ Warning: Error cleaning up files: {e}")
+        metric_inc("skillcam_jobs_total", outcome=outcome)
+        _current_telemetry.reset(token)
+
+    payload["timings"] = telemetry.timings()
+    payload["usage"] = dict(telemetry.usage)
+    return payload
+
+
+def _run_pipeline_stages(
+    job_id: str,
+    bucket: str,
+    storage_path: str,
+    video_path: Path,
+    frames_dir: Optional[Path],
+    progress: "JobProgress",
+    telemetry: "JobTelemetry",
+) -> Tuple[Dict, str]:
+    """The timed stages of run_analysis_pipeline. Returns (payload, outcome)."""
+    adaptive = FRAME_SELECTION_MODE == "adaptive"
+    cached, content_hash, selected, crop = prepare_video(
+        job_id, bucket, storage_path, video_path, frames_dir, progress, telemetry, coarse=adaptive
+    )
+    if cached is not None:
+        return cached, "cache_hit"
+
+    progress.stage_started("analyze")
+    with telemetry.stage("analyze"):
+        if adaptive:
+            frame_analyses, sampling = analyze_adaptively(
+                video_path, frames_dir, selected, content_hash if CACHE_ENABLED else None, progress, crop
+            )
+        else:
+            frame_analyses = analyze_frames_concurrently(
+                selected,
+                on_result=progress.frame_done,
+                content_hash=content_hash if CACHE_ENABLED else None,
+                cancel=progress.cancel_event,
+            )
+            sampling = {
+                "mode": FRAME_SELECTION_MODE,
+                "frames": len(frame_analyses),
+                "frames_failed": len(selected) - len(frame_analyses),
+            }
+
+    progress.check_cancelled()
+    if not frame_analyses:
+        raise PipelineError("Failed to analyze any frames")
+    progress.stage_done("analyze")
+
+    payload = finish_video(job_id, video_path.name, content_hash, frame_analyses, sampling, progress, telemetry)
+    return payload, "ok"
+
+
+def prepare_video(
+    job_id: str,
+    bucket: str,
+    storage_path: str,
+    video_path: Path,
+    frames_dir: Optional[Path],
+    progress: "JobProgress",
+    telemetry: "JobTelemetry",
+    coarse: bool = False,
+    selection_mode: Optional[str] = None,
+) -> Tuple[Optional[Dict], str, List[Tuple[Frame, float]], Optional[CropBox]]:
+    """
+    Download and extract frames for one video (only the coarse set with coarse=True).
+    With IMAGE_MOTION_CROP the frames are cropped to where the video moves.
+    Cached results are looked up for selection_mode (default FRAME_SELECTION_MODE).
+    Returns (cached payload, None, [], None) on a cache hit, else
+    (None, content_hash, selected frames, motion crop or None).
+    """
+    ext = video_path.suffix
+
+    progress.stage_started("download")
+    with telemetry.stage("signed_url"):
+        try:
+            signed_url = create_signed_video_url(bucket, storage_path)
+        except Exception as e:
+            # e.g. a StorageException for a missing object; don't leak it to the client
+            print(f"❌ Error creating signed URL for {bucket}/{storage_path}: {e}")
+            signed_url = None
+    if not signed_url:
+        raise PipelineError("Failed to download video from storage")
+
+    # Repeat request for an object we already analyzed: skip the whole pipeline
+    source_key = None
+    if CACHE_ENABLED:
+        with telemetry.stage("cache_lookup"):
+            source_key = probe_source_key(signed_url, bucket, storage_path)
+            content_hash = cache_get("alias", source_key) if source_key else None
+            cached = cache_get("result", result_cache_key(content_hash, selection_mode)) if content_hash else None
+        if cached:
+            print(f"⚡ Cache hit for {bucket}/{storage_path}")
+            progress.stage_done("download", cache_hit=True)
+            return cached_payload(cached, job_id, ext), None, [], None
+
+    # Download video from Supabase
+    print(f"🎬 Downloading video from Supabase: {bucket}/{storage_path}")
+    with telemetry.stage("download"):
+        download_stats = download_video_from_supabase(bucket, storage_path, video_path, signed_url)
+    if not download_stats:
+        raise PipelineError("Failed to download video from storage")
+
+    telemetry.add(bytes_downloaded=download_stats["bytes"])
+    metric_inc("skillcam_download_bytes_total", download_stats["bytes"])
+
+    content_hash = download_stats["sha256"]
+    if CACHE_ENABLED:
+        if source_key:
+            cache_put("alias", source_key, content_hash)
+        # Same content uploaded under another path
+        cached = cache_get("result", result_cache_key(content_hash, selection_mode))
+        if cached:
+            print(f"⚡ Cache hit for content {content_hash[:12]}")
+            progress.stage_done("download", cache_hit=True)
+            return cached_payload(cached, job_id, ext), None, [], None
+
+    print(f"✅ Video downloaded: {video_path}")
+    progress.stage_done(
+        "download",
+        bytes=download_stats["bytes"],
+        bytes_per_sec=download_stats["bytes_per_sec"],
+    )
+
+    # Extract frames
+    progress.stage_started("extract")
+    try:
+        with telemetry.stage("extract"):
+            crop = find_motion_crop(video_path) if IMAGE_MOTION_CROP else None
+            selected = select_frames(video_path, frames_dir, coarse, crop)
+    except subprocess.CalledProcessError as e:
+        print(f"❌ ffmpeg failed: {e}")
+        raise PipelineError(f"ffmpeg failed: {e}")
+
+    if not selected:
+        raise PipelineError("No frames extracted from video")
+
+    progress.stage_done("extract", frames_total=len(selected))
+    return None, content_hash, selected, crop
+
+
+def finish_video(
+    job_id: str,
+    video_filename: str,
+    content_hash: str,
+    frame_analyses: List[Dict],
+    sampling: Dict,
+    progress: "JobProgress",
+    telemetry: "JobTelemetry",
+) -> Dict:
+    """
+    Run the global summary over a video's frame analyses and build its /upload payload.
+    `sampling` records how the frames were chosen ("mode", "frames", "frames_failed", ...);
+    its "mode" keys the result cache entry.
+    The payload is cached only when no frame failed and the summary call succeeded;
+    a degraded job leaves just its per-frame cache entries, so a retry resumes it.
+    """
+    progress.stage_started("summary")
+    with telemetry.stage("summary"):
+        global_analysis = global_analysis_with_gpt(
+            frame_analyses, on_delta=progress.feedback_delta, cancel=progress.cancel_event
+        )
+    progress.stage_done("summary")
+
+    # Return structured response with metrics and feedback
+    payload = {
+        "job_id": job_id,
+        "video_filename": video_filename,
+        "frame_analyses": frame_analyses,
+        "final_summary": global_analysis.get("feedback", ""),  # Keep for backward compatibility
+        "metrics": {
+            "overallScore": global_analysis.get("overallScore", 0),
+            "accuracy": global_analysis.get("accuracy", 0),
+            "stability": global_analysis.get("stability", 0),
+            "toolUsage": global_analysis.get("toolUsage", 0),
+            "completionTime": global_analysis.get("completionTime", "N/A"),
+        },
+        "feedback": global_analysis.get("feedback", ""),
+        "sampling": sampling,
+    }
+    if CACHE_ENABLED and not sampling.get("frames_failed") and not global_analysis.get("feedback_fallback"):
+        # Keyed by the selection actually used: batches sample a fixed budget even in "adaptive"
+        cache_put("result", result_cache_key(content_hash, sampling["mode"]), payload)
+    return payload
+
+
+# ---------- shared local state ----------
+
+
+_sqlite_local = threading.local()
+
+
+def _sqlite_connect(path: Path, schema: str) -> sqlite3.Connection:
+    """
+    Per-thread connection to a SQLite file shared by all workers on the host,
+    reopened after a fork. SQLite handles locking across processes; keeping the
+    connection open avoids a WAL checkpoint on every close.
+    """
+    if getattr(_sqlite_local, "pid", None) != os.getpid():
+        _sqlite_local.conns = {}
+        _sqlite_local.pid = os.getpid()
+    conn = _sqlite_local.conns.get(path)
+    if conn is not None:
+        return conn
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(schema)
+    _sqlite_local.conns[path] = conn
+    return conn
+
+
+# ---------- result cache ----------
+
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_access);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def _cache_connect() -> sqlite3.Connection:
+    return _sqlite_connect(CACHE_DB_PATH, CACHE_SCHEMA)
+
+
+def _frame_settings() -> Dict:
+    """Settings that change a single frame's analysis."""
+    settings = {
+        "vision_model": VISION_MODEL,
+        "frame_prompt": FRAME_PROMPT_TEMPLATE,
+        "image": [IMAGE_TILE_GRID, IMAGE_JPEG_QSCALE, IMAGE_MAX_BYTES, IMAGE_DETAIL],
+    }
+    if VISION_BATCH_SIZE > 1:
+        settings["batch_prompt"] = BATCH_FRAME_PROMPT_TEMPLATE
+    if STRUCTURED_OUTPUTS:
+        settings["frame_schemas"] = [FRAME_SCHEMA, BATCH_FRAME_SCHEMA]
+    if IMAGE_MOTION_CROP:
+        settings["motion_crop"] = [SCENE_CANDIDATE_FPS, IMAGE_MOTION_THRESHOLD, IMAGE_MOTION_MARGIN]
+    return settings
+
+
+def _settings_hash(settings: Dict) -> str:
+    blob = json.dumps(settings, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(blob).hexdigest()[:16]
+
+
+def frame_version_key() -> str:
+    """Hash of the settings behind one frame's analysis (see _frame_settings)."""
+    return _settings_hash(_frame_settings())
+
+
+def analysis_version_key(selection_mode: Optional[str] = None) -> str:
+    """
+    Hash of every setting that changes what the pipeline returns for a video.
+    selection_mode: the frame selection a run actually used, if not FRAME_SELECTION_MODE.
+    """
+    selection_mode = selection_mode or FRAME_SELECTION_MODE
+    settings = {
+        **_frame_settings(),
+        "summary_model": SUMMARY_MODEL,
+        "fps": FPS,
+        "max_frames": MAX_FRAMES_TO_ANALYZE,
+        "frame_selection": selection_mode,
+        "summary_prompt": SUMMARY_PROMPT,
+        "scoring": LOCAL_SCORING_VERSION,
+    }
+    if STRUCTURED_OUTPUTS:
+        settings["summary_schema"] = SUMMARY_SCHEMA
+    if selection_mode == "scene":
+        settings["scene"] = [SCENE_CANDIDATE_FPS, SCENE_DUP_HASH_DISTANCE, SCENE_DUP_DIFF, SCENE_BLUR_RATIO]
+    if selection_mode == "adaptive":
+        settings["adaptive"] = [
+            ADAPTIVE_COARSE_FRAMES, ADAPTIVE_MAX_FRAMES, ADAPTIVE_SCORE_SPREAD, ADAPTIVE_ISSUE_SPREAD
+        ]
+    return _settings_hash(settings)
+
+
+def result_cache_key(content_hash: str, selection_mode: Optional[str] = None) -> str:
+    return f"{content_hash}:{analysis_version_key(selection_mode)}"
+
+
+def frame_cache_key(content_hash: str, timestamp_sec: float) -> str:
+    return f"{content_hash}:{frame_version_key()}:{timestamp_sec:.3f}"
+
+
+def cache_get(kind: str, key: str):
+    """Look up a cached value and count the hit/miss. Cache errors count as misses."""
+    full_key = f"{kind}:{key}"
+    try:
+        conn = _cache_connect()
+        row = conn.execute("SELECT value FROM entries WHERE key = ?", (full_key,)).fetchone()
+        if row:
+            conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), full_key))
+        conn.execute(
+            "INSERT INTO stats (name, value) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (f"{kind}_{'hits' if row else 'misses'}",),
+        )
+    except sqlite3.Error as e:
+        print(f"⚠️ Cache read failed: {e}")
+        return None
+    return json.loads(row[0]) if row else None
+
+
+def cache_put(kind: str, key: str, value) -> None:
+    """Store a value, then evict least recently used entries above CACHE_MAX_BYTES."""
+    blob = json.dumps(value)
+    try:
+        conn = _cache_connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+            (f"{kind}:{key}", blob, len(blob), time.time()),
+        )
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total > CACHE_MAX_BYTES:
+            evict = []
+            for entry_key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_access").fetchall():
+                if total <= CACHE_MAX_BYTES:
+                    break
+                evict.append((entry_key,))
+                total -= size
+            conn.executemany("DELETE FROM entries WHERE key = ?", evict)
+            conn.execute(
+                "INSERT INTO stats (name, value) VALUES ('evictions', ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (len(evict),),
+            )
+    except sqlite3.Error as e:
+        print(f"⚠️ Cache write failed: {e}")
+
+
+def cache_stats() -> Dict:
+    conn = _cache_connect()
+    stats = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+    entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+    stats.update({"entries": entries, "bytes": size, "max_bytes": CACHE_MAX_BYTES})
+    return stats
+
+
+def cached_payload(cached: Dict, job_id: str, ext: str) -> Dict:
+    """Re-label a cached /upload payload for the current job."""
+    payload = {k: v for k, v in cached.items() if k not in ("timings", "usage")}
+    payload["job_id"] = job_id
+    payload["video_filename"] = f"{job_id}{ext}"
+    payload["cached"] = True
+    return payload
+
+
+# ---------- OpenAI rate governor ----------
+
+
+RATE_GOVERNOR_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    model TEXT PRIMARY KEY,
+    rpm_limit REAL NOT NULL,
+    tpm_limit REAL NOT NULL,
+    requests REAL NOT NULL,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    blocked_until REAL NOT NULL DEFAULT 0
+);
+"""
+
+
+def _rate_governor_connect() -> sqlite3.Connection:
+    return _sqlite_connect(RATE_GOVERNOR_DB_PATH, RATE_GOVERNOR_SCHEMA)
+
+
+def estimate_image_tokens(width: int, height: int, detail: str, model: str) -> int:
+    """
+    Tokens OpenAI bills for one image: a flat base at detail "low"; otherwise the
+    image is fit within 2048x2048, its short side is brought down to 768px, and
+    each 512px tile it spans costs extra (see IMAGE_TOKEN_COSTS).
+    """
+    base, per_tile = next(
+        (costs for prefix, costs in IMAGE_TOKEN_COSTS.items() if model.startswith(prefix)),
+        DEFAULT_IMAGE_TOKEN_COST,
+    )
+    if detail == "low":
+        return base
+    scale = min(1.0, 2048 / max(width, height), 768 / min(width, height))
+    tiles = math.ceil(width * scale / IMAGE_TILE_SIZE) * math.ceil(height * scale / IMAGE_TILE_SIZE)
+    return base + per_tile * tiles
+
+
+def _data_url_image_size(url: str) -> Optional[Tuple[int, int]]:
+    """(width, height) of a base64 JPEG data URL, read from its header."""
+    if not url.startswith("data:image/jpeg;base64,"):
+        return None
+    b64 = url[len("data:image/jpeg;base64,"):]
+    try:
+        # ffmpeg's JPEG headers are well under 3 KB; fall back to the whole image
+        return jpeg_size(base64.b64decode(b64[:4096])) or jpeg_size(base64.b64decode(b64))
+    except ValueError:
+        return None
+
+
+def estimate_message_image_tokens(messages: List[Dict], model: str) -> int:
+    """
+    Image tokens in a chat request, from each image's size and detail level
+    (estimate_image_tokens). An image whose size can't be read counts as
+    IMAGE_TOKEN_ESTIMATE, or by default as the largest image the model bills.
+    """
+    tokens = 0
+    for message in messages:
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        for part in content:
+            if part.get("type") != "image_url":
                 continue
+            image_url = part.get("image_url") or {}
+            size = _data_url_image_size(image_url.get("url", ""))
+            if size is None:
+                tokens += IMAGE_TOKEN_ESTIMATE or estimate_image_tokens(2048, 768, "high", model)
+            else:
+                tokens += estimate_image_tokens(*size, image_url.get("detail", "auto"), model)
+    return tokens
+
+
+def estimate_request_tokens(messages: List[Dict], max_tokens: Optional[int], model: str = VISION_MODEL) -> int:
+    """
+    Rough token count of a chat request, the way the TPM limit counts it:
+    ~4 characters per text token, estimate_message_image_tokens for the images,
+    plus max_tokens.
+    """
+    chars = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") != "image_url":
+                    chars += len(part.get("text", ""))
+    image_tokens = estimate_message_image_tokens(messages, model)
+    return chars // 4 + 4 * len(messages) + image_tokens + (max_tokens or 0)
+
+
+@contextmanager
+def _rate_governor_bucket(model: str):
+    """
+    Yield the model's bucket row, refilled to now, inside a write transaction;
+    the caller's changes to it are saved on exit. BEGIN IMMEDIATE serializes
+    every worker on the host.
+    """
+    conn = _rate_governor_connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        now = time.time()
+        row = conn.execute(
+            "SELECT rpm_limit, tpm_limit, requests, tokens, updated, blocked_until FROM buckets WHERE model = ?",
+            (model,),
+        ).fetchone()
+        if row is None:
+            row = (
+                OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT,
+                OPENAI_RPM_LIMIT * RATE_GOVERNOR_HEADROOM, OPENAI_TPM_LIMIT * RATE_GOVERNOR_HEADROOM,
+                now, 0.0,
+            )
+        bucket = dict(zip(("rpm_limit", "tpm_limit", "requests", "tokens", "updated", "blocked_until"), row))
+
+        # Both buckets refill continuously up to the usable share of the per-minute limit
+        elapsed = max(0.0, now - bucket["updated"])
+        for key, limit in (("requests", "rpm_limit"), ("tokens", "tpm_limit")):
+            capacity = bucket[limit] * RATE_GOVERNOR_HEADROOM
+            bucket[key] = min(capacity, bucket[key] + elapsed * capacity / 60)
+        bucket["updated"] = now
+
+        yield bucket
+
+        conn.execute(
+            "INSERT OR REPLACE INTO buckets (model, rpm_limit, tpm_limit, requests, tokens, updated, blocked_until) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (model, bucket["rpm_limit"], bucket["tpm_limit"], bucket["requests"], bucket["tokens"],
+             bucket["updated"], bucket["blocked_until"]),
+        )
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def rate_governor_acquire(model: str, tokens: int) -> float:
+    """
+    Reserve one request and `tokens` tokens for `model`, then sleep until the
+    reservation fits under the limits. Buckets may go negative: each caller is
+    queued behind the reservations made before it. Returns the seconds waited.
+    """
+    if not RATE_GOVERNOR_ENABLED:
+        return 0.0
+    try:
+        with _rate_governor_bucket(model) as bucket:
+            bucket["requests"] -= 1
+            bucket["tokens"] -= tokens
+            wait = max(
+                0.0,
+                -bucket["requests"] * 60 / (bucket["rpm_limit"] * RATE_GOVERNOR_HEADROOM),
+                -bucket["tokens"] * 60 / (bucket["tpm_limit"] * RATE_GOVERNOR_HEADROOM),
+                bucket["blocked_until"] - bucket["updated"],
+            )
+    except sqlite3.Error as e:
+        print(f"⚠️ Rate governor unavailable: {e}")
+        return 0.0
+
+    if wait > 0:
+        # Jitter so queued callers across workers don't all fire on the same tick
+        wait += random.uniform(0, RATE_GOVERNOR_JITTER)
+        metric_observe("skillcam_rate_governor_wait_seconds", wait, model=model)
+        time.sleep(wait)
+    return wait
+
+
+def rate_governor_observe(model: str, headers) -> Optional[float]:
+    """
+    Recalibrate the model's buckets from OpenAI response headers:
+    x-ratelimit-limit-* replace the configured limits, x-ratelimit-remaining-*
+    pull the buckets down when other clients of the account used more than we
+    saw, and retry-after pauses every worker. Returns retry-after in seconds, if sent.
+    """
+    def _number(name: str) -> Optional[float]:
+        try:
+            return float(headers.get(name))
+        except (TypeError, ValueError):
+            return None
+
+    retry_after = _number("retry-after-ms")
+    retry_after = retry_after / 1000 if retry_after is not None else _number("retry-after")
+
+    if not RATE_GOVERNOR_ENABLED:
+        return retry_after
+    try:
+        with _rate_governor_bucket(model) as bucket:
+            for key, limit in (("requests", "rpm_limit"), ("tokens", "tpm_limit")):
+                new_limit = _number(f"x-ratelimit-limit-{key}")
+                if new_limit:
+                    bucket[limit] = new_limit
+                remaining = _number(f"x-ratelimit-remaining-{key}")
+                if remaining is not None:
+                    # Keep the same headroom below the server's count as below the limit
+                    reserve = bucket[limit] * (1 - RATE_GOVERNOR_HEADROOM)
+                    bucket[key] = min(bucket[key], remaining - reserve)
+            if retry_after is not None:
+                bucket["blocked_until"] = max(bucket["blocked_until"], bucket["updated"] + retry_after)
+    except sqlite3.Error as e:
+        print(f"⚠️ Rate governor unavailable: {e}")
+    return retry_after
+
+
+# ---------- metrics ----------
+
+
+METRICS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    suffix TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (name, labels, suffix)
+);
+"""
+
+_METRIC_HELP = {
+    "skillcam_stage_seconds": "Time spent in each /upload pipeline stage",
+    "skillcam_openai_call_seconds": "Latency of successful OpenAI chat completion calls",
+    "skillcam_openai_tokens_total": "Tokens reported in OpenAI responses",
+    "skillcam_openai_retries_total": "OpenAI calls retried after a rate limit",
+    "skillcam_openai_retry_wait_seconds_total": "Time slept in rate-limit backoff",
+    "skillcam_openai_errors_total": "OpenAI calls that failed without a retry",
+    "skillcam_openai_rate_limited_total": "OpenAI calls answered with a rate-limit error",
+    "skillcam_rate_governor_wait_seconds": "Time callers were queued by the rate governor before an OpenAI call",
+    "skillcam_download_bytes_total": "Video bytes downloaded from storage",
+    "skillcam_jobs_total": "Analysis jobs by outcome",
+    "skillcam_structured_outputs_total": (
+        "JSON replies by outcome: parsed, repaired locally, unparseable, retried, or given up on (fallback)"
+    ),
+}
+
+
+def _labels_key(labels: Dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+def _metric_upsert(rows: List[Tuple]) -> None:
+    if not METRICS_ENABLED:
+        return
+    try:
+        conn = _sqlite_connect(METRICS_DB_PATH, METRICS_SCHEMA)
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT INTO samples (name, kind, labels, suffix, value) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(name, labels, suffix) DO UPDATE SET value = value + excluded.value",
+                rows,
+            )
+    except sqlite3.Error as e:
+        print(f"⚠️ Metrics write failed: {e}")
 
-        if not frame_analyses:
-            return jsonify({"error": "Failed to analyze any frames"}), 500
 
-        global_analysis = global_analysis_with_gpt(frame_analyses)
+def metric_inc(name: str, value: float = 1.0, **labels) -> None:
+    """Add to a counter."""
+    _metric_upsert([(name, "counter", _labels_key(labels), "", value)])
+
+
+def metric_observe(name: str, value: float, **labels) -> None:
+    """Record one observation in a histogram with HISTOGRAM_BUCKETS."""
+    key = _labels_key(labels)
+    rows = [(name, "histogram", key, f"le={le}", 1.0 if value <= le else 0.0) for le in HISTOGRAM_BUCKETS]
+    rows += [
+        (name, "histogram", key, "le=+Inf", 1.0),
+        (name, "histogram", key, "sum", value),
+        (name, "histogram", key, "count", 1.0),
+    ]
+    _metric_upsert(rows)
+
+
+def render_metrics() -> str:
+    """All samples in the Prometheus text exposition format."""
+    conn = _sqlite_connect(METRICS_DB_PATH, METRICS_SCHEMA)
+    rows = conn.execute("SELECT name, kind, labels, suffix, value FROM samples").fetchall()
+
+    def _order(row):
+        name, _, labels, suffix, _ = row
+        # Histogram buckets by ascending le (+Inf last), then _count and _sum
+        if suffix.startswith("le="):
+            return (name, labels, 0, float(suffix[3:].replace("+Inf", "inf")))
+        return (name, labels, 1, suffix)
+
+    rows.sort(key=_order)
+
+    lines = []
+    seen = set()
+    for name, kind, labels, suffix, value in rows:
+        if name not in seen:
+            seen.add(name)
+            if name in _METRIC_HELP:
+                lines.append(f"# HELP {name} {_METRIC_HELP[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            lines.append(f"{name}{labels} {value:g}")
+        elif suffix.startswith("le="):
+            le = suffix[3:]
+            inner = labels[1:-1] + "," if labels else ""
+            lines.append(f'{name}_bucket{{{inner}le="{le}"}} {value:g}')
+        else:
+            lines.append(f"{name}_{suffix}{labels} {value:g}")
+
+    if CACHE_ENABLED:
+        try:
+            stats = cache_stats()
+            lines.append("# HELP skillcam_cache_events_total Analysis cache lookups and evictions")
+            lines.append("# TYPE skillcam_cache_events_total counter")
+            for event, value in sorted(stats.items()):
+                if event.endswith(("_hits", "_misses")) or event == "evictions":
+                    lines.append(f'skillcam_cache_events_total{{event="{event}"}} {value}')
+        except sqlite3.Error as e:
+            print(f"⚠️ Cache stats unavailable for /metrics: {e}")
+
+    return "\n".join(lines) + "\n"
+
+
+_current_telemetry: contextvars.ContextVar = contextvars.ContextVar("job_telemetry", default=None)
+
+
+class JobTelemetry:
+    """
+    Per-job stage timings and OpenAI usage, returned as the "timings" and "usage"
+    blocks of the /upload payload. Every number is also recorded in /metrics.
+    """
+
+    def __init__(self, started_at: Optional[float] = None):
+        """started_at: wall-clock start, for a job resumed from its saved record."""
+        self._lock = threading.Lock()
+        self._started = time.monotonic() - (time.time() - started_at if started_at else 0)
+        self.stages: Dict[str, float] = {}
+        self.vision_calls: List[float] = []
+        self.usage = {
+            "openai_calls": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0,
+            "vision_calls": 0,
+            "retries": 0,
+            "retry_wait_seconds": 0.0,
+            "json_repairs": 0,
+            "json_retries": 0,
+            "json_fallbacks": 0,
+            "bytes_downloaded": 0,
+        }
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - start
+            self.stages[name] = round(seconds, 3)
+            metric_observe("skillcam_stage_seconds", seconds, stage=name)
+
+    def add(self, **usage) -> None:
+        with self._lock:
+            for key, value in usage.items():
+                self.usage[key] += value
+
+    def timings(self) -> Dict:
+        return {
+            "stages": dict(self.stages),
+            "vision_calls": list(self.vision_calls),
+            "total": round(time.monotonic() - self._started, 3),
+        }
+
+
+def record_openai_call(model: str, purpose: str, seconds: float, usage) -> None:
+    metric_observe("skillcam_openai_call_seconds", seconds, model=model, purpose=purpose)
+    telemetry = _current_telemetry.get()
+    if telemetry is not None:
+        if purpose.startswith("vision"):
+            with telemetry._lock:
+                telemetry.vision_calls.append(round(seconds, 3))
+            telemetry.add(vision_calls=1)
+        telemetry.add(openai_calls=1)
+    if usage is not None:
+        record_openai_usage(model, usage)
+
+
+def record_openai_usage(model: str, usage) -> None:
+    """Token counts from a response (or the final chunk of a stream)."""
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    metric_inc("skillcam_openai_tokens_total", prompt_tokens, model=model, type="prompt")
+    metric_inc("skillcam_openai_tokens_total", completion_tokens, model=model, type="completion")
+    telemetry = _current_telemetry.get()
+    if telemetry is not None:
+        telemetry.add(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens,
+        )
+
+
+def record_openai_retry(model: str, delay: float) -> None:
+    metric_inc("skillcam_openai_retries_total", model=model)
+    metric_inc("skillcam_openai_retry_wait_seconds_total", delay, model=model)
+    telemetry = _current_telemetry.get()
+    if telemetry is not None:
+        telemetry.add(retries=1, retry_wait_seconds=delay)
+
+
+def record_structured_output(purpose: str, outcome: str) -> None:
+    """Count a JSON reply outcome: parsed, repaired, unparseable, retried or fallback."""
+    metric_inc("skillcam_structured_outputs_total", purpose=purpose, outcome=outcome)
+    telemetry = _current_telemetry.get()
+    key = {"repaired": "json_repairs", "retried": "json_retries", "fallback": "json_fallbacks"}.get(outcome)
+    if telemetry is not None and key:
+        telemetry.add(**{key: 1})
+
+
+def map_in_context(pool: ThreadPoolExecutor, fn: Callable, items: List) -> List:
+    """pool.map that carries the caller's context (job telemetry) into the workers."""
+    futures = [pool.submit(contextvars.copy_context().run, fn, item) for item in items]
+    return [f.result() for f in futures]
+
+
+# ---------- async jobs ----------
+
+
+def _job_file(job_id: str) -> Path:
+    return JOBS_FOLDER / f"{job_id}.json"
+
+
+def save_job(record: Dict) -> None:
+    """Persist a job record atomically so every gunicorn worker can serve it."""
+    path = _job_file(record["job_id"])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(record, f)
+    os.replace(tmp_path, path)
+
+
+def load_job(job_id: str) -> Optional[Dict]:
+    try:
+        with open(_job_file(job_id)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def prune_old_jobs() -> None:
+    """Drop job records (and heartbeats of gone workers) older than JOB_TTL_SECONDS."""
+    cutoff = time.time() - JOB_TTL_SECONDS
+    for path in [*JOBS_FOLDER.glob("*.json"), *(JOBS_FOLDER / "workers").glob("*")]:
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            continue
+
+
+def _heartbeat_file(owner: str) -> Path:
+    return JOBS_FOLDER / "workers" / owner
+
+
+def owner_alive(owner: str) -> bool:
+    """Whether the worker process `owner` has sent a heartbeat recently."""
+    try:
+        return time.time() - _heartbeat_file(owner).stat().st_mtime < 3 * JOB_HEARTBEAT_SECONDS
+    except FileNotFoundError:
+        return False
+
 
-        # Return structured response with metrics and feedback
-        payload = {
+def fail_orphaned_job(record: Dict) -> Dict:
+    """
+    Mark a queued or running job whose owning worker process is gone (restart,
+    timeout, OOM) as failed, so clients stop polling it. Returns the record.
+    """
+    owner = record.get("owner")
+    if record.get("status") not in ("queued", "running") or not owner or owner_alive(owner):
+        return record
+    print(f"⚠️ Job {record['job_id']} lost its worker {owner}, marking it failed")
+    progress = JobProgress(record["job_id"])
+    progress.record = record
+    progress.fail("The worker running this job restarted, submit it again", 503)
+    return progress.record
+
+
+class JobProgress:
+    """
+    Tracks status and per-stage progress for one job.
+    With persist=True every update is written to JOBS_FOLDER for GET /jobs/<job_id>.
+    """
+
+    def __init__(self, job_id: str, persist: bool = True):
+        self.persist = persist
+        self.cancel_event = threading.Event()
+        self._lock = threading.Lock()
+        now = time.time()
+        self.record = {
             "job_id": job_id,
-            "video_filename": video_path.name,
-            "frame_analyses": frame_analyses,
-            "final_summary": global_analysis.get("feedback", ""),  # Keep for backward compatibility
-            "metrics": {
-                "overallScore": global_analysis.get("overallScore", 0),
-                "accuracy": global_analysis.get("accuracy", 0),
-                "stability": global_analysis.get("stability", 0),
-                "toolUsage": global_analysis.get("toolUsage", 0),
-                "completionTime": global_analysis.get("completionTime", "N/A"),
-            },
-            "feedback": global_analysis.get("feedback", ""),
+            "status": "queued",
+            "created_at": now,
+            "updated_at": now,
+            "stages": {stage: {"status": "pending"} for stage in PIPELINE_STAGES},
+            "frames_total": None,
+            "frames_analyzed": 0,
+            "result": None,
+            "error": None,
+            "owner": None,
         }
-        return jsonify(payload)
-    
+
+    def _update(self, mutate) -> None:
+        with self._lock:
+            mutate(self.record)
+            self.record["updated_at"] = time.time()
+            if self.persist:
+                save_job(self.record)
+
+    def queued(self) -> None:
+        def _mutate(r):
+            r["owner"] = _worker_id
+        self._update(_mutate)
+
+    def detach(self) -> None:
+        """The job no longer runs in this process (an offline batch waits on OpenAI)."""
+        def _mutate(r):
+            r["owner"] = None
+        self._update(_mutate)
+
+    def check_cancelled(self) -> None:
+        if self.cancel_event.is_set():
+            raise PipelineError("Job cancelled", 499)
+
+    def stage_started(self, stage: str) -> None:
+        self.check_cancelled()
+
+        def _mutate(r):
+            r["status"] = "running"
+            r["stages"][stage] = {"status": "running", "started_at": time.time()}
+        self._update(_mutate)
+
+    def stage_done(self, stage: str, frames_total: Optional[int] = None, **info) -> None:
+        def _mutate(r):
+            entry = r["stages"][stage]
+            entry.update(info)
+            entry["status"] = "done"
+            entry["finished_at"] = time.time()
+            if frames_total is not None:
+                r["frames_total"] = frames_total
+        self._update(_mutate)
+
+    def frame_done(self, analysis: Optional[Dict]) -> None:
+        def _mutate(r):
+            r["frames_analyzed"] += 1
+        self._update(_mutate)
+
+    def frames_added(self, count: int) -> None:
+        """Adaptive sampling extracted `count` more frames during the analyze stage."""
+        def _mutate(r):
+            r["frames_total"] = (r["frames_total"] or 0) + count
+        self._update(_mutate)
+
+    def feedback_delta(self, text: str) -> None:
+        """Called with each streamed fragment of the summary feedback."""
+
+    def complete(self, payload: Dict) -> None:
+        def _mutate(r):
+            r["status"] = "completed"
+            r["result"] = payload
+        self._update(_mutate)
+
+    def fail(self, error: str, status_code: int = 500) -> None:
+        def _mutate(r):
+            r["status"] = "failed"
+            r["error"] = error
+            r["error_status"] = status_code
+            for entry in r.get("stages", {}).values():
+                if entry["status"] == "running":
+                    entry["status"] = "failed"
+        self._update(_mutate)
+
+
+class StreamingProgress(JobProgress):
+    """JobProgress that also pushes Server-Sent Events for /upload/stream onto a queue."""
+
+    def __init__(self, job_id: str, events: "queue.Queue"):
+        super().__init__(job_id, persist=False)
+        self.events = events
+
+    def stage_done(self, stage: str, frames_total: Optional[int] = None, **info) -> None:
+        super().stage_done(stage, frames_total, **info)
+        if stage == "download":
+            self.events.put(("download", info))
+        elif stage == "extract":
+            self.events.put(("frames", {"count": frames_total}))
+
+    def frame_done(self, analysis: Optional[Dict]) -> None:
+        super().frame_done(analysis)
+        if analysis is not None:
+            self.events.put(("frame", analysis))
+
+    def frames_added(self, count: int) -> None:
+        super().frames_added(count)
+        self.events.put(("frames", {"count": self.record["frames_total"]}))
+
+    def feedback_delta(self, text: str) -> None:
+        self.events.put(("feedback_delta", {"text": text}))
+
+
+_job_queue: "queue.Queue" = None
+_job_workers_pid = None
+_job_workers_lock = threading.Lock()
+_worker_id = None  # owner of the jobs queued in this process, "<pid>-<random>"
+
+
+def _heartbeat(owner: str) -> None:
+    path = _heartbeat_file(owner)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    while True:
+        path.touch()
+        time.sleep(JOB_HEARTBEAT_SECONDS)
+
+
+def _job_worker() -> None:
+    while True:
+        run_job = _job_queue.get()
+        try:
+            run_job()
+        except Exception as e:
+            print(f"❌ Unexpected error in job worker: {e}")
+        finally:
+            _job_queue.task_done()
+
+
+def _ensure_job_workers() -> "queue.Queue":
+    """
+    Start the worker pool lazily, once per process (safe across forks), with a
+    heartbeat so other workers can tell when this process and its queue are gone.
+    """
+    global _job_queue, _job_workers_pid, _worker_id
+    with _job_workers_lock:
+        if _job_workers_pid != os.getpid():
+            _job_queue = queue.Queue(maxsize=JOB_QUEUE_DEPTH)
+            for n in range(JOB_WORKERS):
+                threading.Thread(target=_job_worker, name=f"job-worker-{n}", daemon=True).start()
+            _worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+            _heartbeat_file(_worker_id).parent.mkdir(parents=True, exist_ok=True)
+            _heartbeat_file(_worker_id).touch()
+            threading.Thread(target=_heartbeat, args=(_worker_id,), name="job-heartbeat", daemon=True).start()
+            _job_workers_pid = os.getpid()
+    return _job_queue
+
+
+def enqueue_job(run_job: Callable[[], None]) -> bool:
+    """Queue a callable for the worker pool. Returns False when the queue is full."""
+    job_queue = _ensure_job_workers()
+    prune_old_jobs()
+    try:
+        job_queue.put_nowait(run_job)
+    except queue.Full:
+        return False
+    return True
+
+
+def _run_queued_analysis(job_id: str, bucket: str, storage_path: str, progress: JobProgress) -> None:
+    try:
+        payload = run_analysis_pipeline(job_id, bucket, storage_path, progress)
+        progress.complete(payload)
+    except PipelineError as e:
+        progress.fail(e.message, e.status_code)
+    except Exception as e:
+        print(f"❌ Unexpected error in job {job_id}: {e}")
+        progress.fail(f"Internal server error: {str(e)}")
+
+
+def enqueue_analysis_job(job_id: str, bucket: str, storage_path: str) -> bool:
+    """Queue a single-video job. Returns False when the queue is full."""
+    progress = JobProgress(job_id)
+    if not enqueue_job(lambda: _run_queued_analysis(job_id, bucket, storage_path, progress)):
+        return False
+    progress.queued()
+    return True
+
+
+def _wants_async(data: Dict) -> bool:
+    flag = data.get("async", request.args.get("async"))
+    if isinstance(flag, str):
+        return flag.lower() in ("1", "true", "yes")
+    return bool(flag)
+
+
+# ---------- batch analysis ----------
+
+
+class BatchProgress:
+    """Status record for a /upload/batch request, persisted like a job record."""
+
+    def __init__(self, batch_id: str, videos: List[Dict], mode: str):
+        self._lock = threading.Lock()
+        now = time.time()
+        self.record = {
+            "job_id": batch_id,
+            "type": "batch",
+            "mode": mode,
+            "status": "queued",
+            "created_at": now,
+            "updated_at": now,
+            "jobs": [
+                {
+                    "job_id": v["job_id"],
+                    "videoPath": v["storage_path"],
+                    "bucket": v["bucket"],
+                    "status": "queued",
+                }
+                for v in videos
+            ],
+            "frames_total": None,
+            "frames_analyzed": 0,
+            "openai_batch_id": None,
+            "openai_batch_status": None,
+            "results": None,
+            "error": None,
+            "owner": None,
+        }
+
+    @classmethod
+    def from_record(cls, record: Dict) -> "BatchProgress":
+        """Pick up a batch from its saved record."""
+        batch = cls.__new__(cls)
+        batch._lock = threading.Lock()
+        batch.record = record
+        return batch
+
+    def update(self, **fields) -> None:
+        with self._lock:
+            self.record.update(fields)
+            self.record["updated_at"] = time.time()
+            save_job(self.record)
+
+    def set_job_status(self, index: int, status: str) -> None:
+        with self._lock:
+            self.record["jobs"][index]["status"] = status
+            self.record["updated_at"] = time.time()
+            save_job(self.record)
+
+
+def _usage_from_dict(usage: Optional[Dict]):
+    return SimpleNamespace(**usage) if isinstance(usage, dict) else None
+
+
+def submit_frames_offline(
+    selected: List[Tuple[Frame, float]],
+    cache_keys: List[Optional[str]],
+    custom_ids: List[str],
+    batch: BatchProgress,
+) -> Tuple[List[Optional[Dict]], Optional[object]]:
+    """
+    Send the frames that aren't in the per-frame cache to the OpenAI Batch API,
+    one JSONL request per frame, and record the batch on `batch`.
+    Returns (one entry per frame in order: the cached analysis or None,
+    the OpenAI batch or None when every frame was cached).
+    """
+    results: List[Optional[Dict]] = [None] * len(selected)
+    lines = []
+    for i, ((frame, timestamp_sec), cache_key) in enumerate(zip(selected, cache_keys)):
+        cached = cache_get("frame", cache_key) if cache_key else None
+        if cached is not None:
+            cached["frame_file"] = frame_label(frame, timestamp_sec)
+            results[i] = cached
+            continue
+        lines.append(
+            {
+                "custom_id": custom_ids[i],
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": frame_request(frame, timestamp_sec),
+            }
+        )
+    if not lines:
+        return results, None
+
+    jsonl = "\n".join(json.dumps(line) for line in lines).encode("utf-8")
+    openai_client = get_openai_client()
+    input_file = openai_client.files.create(file=("frames.jsonl", jsonl), purpose="batch")
+    openai_batch = openai_client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+        metadata={"skillcam_batch_id": batch.record["job_id"]},
+    )
+    print(f"📦 Submitted OpenAI batch {openai_batch.id} with {len(lines)} frame requests")
+    batch.update(openai_batch_id=openai_batch.id, openai_batch_status=openai_batch.status)
+    return results, openai_batch
+
+
+def collect_offline_results(openai_batch, frames: List[Dict]) -> List[Optional[Dict]]:
+    """
+    Map the output of a finished OpenAI batch back onto `frames`, the entries saved
+    at submission (custom_id, timestamp, frame_file, cache_key, cached analysis).
+    A reply that stays unparseable after repair gets its follow-up online, rebuilt
+    from the batch's input file. Returns one entry per frame (None for a failed frame).
+    """
+    results: List[Optional[Dict]] = [f.get("analysis") for f in frames]
+    index_by_id = {f["custom_id"]: i for i, f in enumerate(frames) if f.get("analysis") is None}
+
+    # Expired batches still return the requests that finished
+    if not openai_batch.output_file_id:
+        raise PipelineError(f"OpenAI batch {openai_batch.id} {openai_batch.status} without output")
+
+    openai_client = get_openai_client()
+    requests_by_id: Dict[str, Dict] = {}
+
+    def _request(custom_id: str) -> Dict:
+        # The frames themselves are gone by now; the input file still has every request
+        if not requests_by_id:
+            for raw_line in openai_client.files.content(openai_batch.input_file_id).text.splitlines():
+                if raw_line.strip():
+                    line = json.loads(raw_line)
+                    requests_by_id[line["custom_id"]] = line["body"]
+        return requests_by_id[custom_id]
+
+    output = openai_client.files.content(openai_batch.output_file_id).text
+    for raw_line in output.splitlines():
+        if not raw_line.strip():
+            continue
+        line = json.loads(raw_line)
+        custom_id = line.get("custom_id")
+        i = index_by_id.get(custom_id)
+        response = line.get("response") or {}
+        if i is None or response.get("status_code") != 200:
+            print(f"⚠️ Batch request {custom_id} failed: {line.get('error') or response.get('status_code')}")
+            continue
+
+        body = response.get("body") or {}
+        usage = _usage_from_dict(body.get("usage"))
+        if usage is not None:
+            record_openai_usage(body.get("model", VISION_MODEL), usage)
+        timestamp_sec = frames[i]["timestamp"]
+        message = (body.get("choices") or [{}])[0].get("message") or {}
+        content = message.get("content") or ""
+        if isinstance(content, list):
+            content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+
+        def _validate(data: object) -> Dict:
+            return validate_frame_analysis(data, timestamp_sec)
+
+        try:
+            value, repaired = repair_json(content)
+            analysis = _validate(value)
+            record_structured_output("vision", "repaired" if repaired else "parsed")
+        except ValueError:
+            try:
+                analysis = structured_reply(_request(custom_id), content, "vision", _validate)
+            except Exception as e:
+                print(f"⚠️ Batch request {custom_id} gave no usable analysis: {e}")
+                continue
+        if frames[i].get("cache_key"):
+            cache_put("frame", frames[i]["cache_key"], analysis)
+        analysis["frame_file"] = frames[i]["frame_file"]
+        results[i] = analysis
+
+    return results
+
+
+def batch_selection_mode() -> str:
+    """Frame selection batches use: a fixed budget, since "adaptive" needs the video between rounds."""
+    return "scene" if FRAME_SELECTION_MODE == "scene" else "linspace"
+
+
+def _fail_batch_video(batch: BatchProgress, i: int, v: Dict, message: str, status_code: int = 500) -> None:
+    v["error"] = {"error": message, "status": status_code}
+    v["progress"].fail(message, status_code)
+    batch.set_job_status(i, "failed")
+
+
+def _report_batch_video(batch: BatchProgress, i: int, v: Dict) -> None:
+    """Store a video's finished payload (or count its failure), once."""
+    if v.get("reported"):
+        return
+    if v["payload"] is not None:
+        v["payload"]["timings"] = v["telemetry"].timings()
+        v["payload"]["usage"] = dict(v["telemetry"].usage)
+        v["progress"].complete(v["payload"])
+        batch.set_job_status(i, "completed")
+        metric_inc("skillcam_jobs_total", outcome=v["outcome"])
+    else:
+        metric_inc("skillcam_jobs_total", outcome="error")
+    v["reported"] = True
+
+
+def _fail_batch(batch: BatchProgress, videos: List[Dict], message: str, status_code: int = 500) -> None:
+    for i, v in enumerate(videos):
+        if v["payload"] is None and v["error"] is None:
+            _fail_batch_video(batch, i, v, message, status_code)
+    batch.update(status="failed", error=message)
+
+
+def _complete_batch(
+    batch: BatchProgress,
+    videos: List[Dict],
+    pooled: List[Tuple[int, int]],
+    results: List[Optional[Dict]],
+    batch_telemetry: "JobTelemetry",
+) -> None:
+    """Summarize each video from its pooled frame results and store the batch results."""
+    batch.update(frames_analyzed=sum(r is not None for r in results))
+
+    analyses: Dict[int, List[Dict]] = {}
+    for (i, _), analysis in zip(pooled, results):
+        videos[i]["progress"].frame_done(analysis)
+        if analysis is not None:
+            analyses.setdefault(i, []).append(analysis)
+
+    def _finish(i: int) -> None:
+        v = videos[i]
+        if not v["frames"] or v["error"] or v["payload"] is not None:
+            return
+        v["telemetry"].stages["analyze"] = batch_telemetry.stages.get("analyze")
+        token = _current_telemetry.set(v["telemetry"])
+        try:
+            if not analyses.get(i):
+                raise PipelineError("Failed to analyze any frames")
+            v["progress"].stage_done("analyze")
+            sampling = {
+                "mode": batch_selection_mode(),
+                "frames": len(analyses[i]),
+                "frames_failed": v["frames"] - len(analyses[i]),
+            }
+            v["payload"] = finish_video(
+                v["job_id"], v["video_path"].name, v["content_hash"], analyses[i], sampling,
+                v["progress"], v["telemetry"],
+            )
+        except PipelineError as e:
+            _fail_batch_video(batch, i, v, e.message, e.status_code)
+        except Exception as e:
+            print(f"❌ Unexpected error summarizing {v['storage_path']}: {e}")
+            _fail_batch_video(batch, i, v, f"Internal server error: {str(e)}")
+        finally:
+            _current_telemetry.reset(token)
+
+    with ThreadPoolExecutor(max_workers=FRAME_ANALYSIS_CONCURRENCY, thread_name_prefix="batch-summary") as pool:
+        list(pool.map(_finish, range(len(videos))))
+
+    for i, v in enumerate(videos):
+        _report_batch_video(batch, i, v)
+
+    batch.update(
+        status="completed",
+        results=[v["payload"] if v["payload"] is not None else v["error"] for v in videos],
+        timings=batch_telemetry.timings(),
+        usage=dict(batch_telemetry.usage),
+    )
+
+
+def run_analysis_batch(batch: BatchProgress, videos: List[Dict], mode: str) -> None:
+    """
+    Analyze several videos as one job:
+    - download + frame extraction run in parallel (BATCH_PREPARE_WORKERS)
+    - the frames of every video share one pool of vision requests, or one OpenAI
+      Batch API job when mode is "offline"
+    - each video then gets its own summary and /upload payload
+    Every video keeps its own job record at /jobs/<job_id>; the batch record at
+    /jobs/<batch_id> collects the per-video results.
+    In offline mode the worker returns once the OpenAI batch is submitted, leaving
+    the batch "submitted"; poll_offline_batch finishes it from the saved record.
+    """
+    batch_id = batch.record["job_id"]
+    batch.update(status="running")
+    batch_telemetry = JobTelemetry()
+
+    for v in videos:
+        ext = Path(v["storage_path"]).suffix or ".mp4"
+        v["video_path"] = UPLOAD_FOLDER / f"{v['job_id']}{ext}"
+        v["frames_dir"] = FRAMES_FOLDER / v["job_id"] if FRAME_SOURCE == "disk" else None
+        v["telemetry"] = JobTelemetry()
+        v["payload"] = None
+        v["outcome"] = "ok"
+        v["error"] = None
+        v["content_hash"] = None
+        v["selected"] = []
+        v["frames"] = 0
+
+    def _prepare(i: int) -> None:
+        v = videos[i]
+        token = _current_telemetry.set(v["telemetry"])
+        try:
+            cached, v["content_hash"], v["selected"], _ = prepare_video(
+                v["job_id"], v["bucket"], v["storage_path"], v["video_path"], v["frames_dir"],
+                v["progress"], v["telemetry"], selection_mode=batch_selection_mode(),
+            )
+            v["frames"] = len(v["selected"])
+            if cached is not None:
+                v["payload"] = cached
+                v["outcome"] = "cache_hit"
+        except PipelineError as e:
+            _fail_batch_video(batch, i, v, e.message, e.status_code)
+        except Exception as e:
+            print(f"❌ Unexpected error preparing {v['storage_path']}: {e}")
+            _fail_batch_video(batch, i, v, f"Internal server error: {str(e)}")
+        finally:
+            _current_telemetry.reset(token)
+            # Frames are extracted; the video itself is no longer needed
+            if v["video_path"].exists():
+                v["video_path"].unlink()
+
+    try:
+        with ThreadPoolExecutor(max_workers=BATCH_PREPARE_WORKERS, thread_name_prefix="batch-prepare") as pool:
+            list(pool.map(_prepare, range(len(videos))))
+
+        # Pool the frames of every video that still needs analysis
+        pooled = [(i, n) for i, v in enumerate(videos) for n in range(len(v["selected"]))]
+        frames = [videos[i]["selected"][n] for i, n in pooled]
+        cache_keys = [
+            frame_cache_key(videos[i]["content_hash"], frames[k][1]) if CACHE_ENABLED else None
+            for k, (i, n) in enumerate(pooled)
+        ]
+        batch.update(frames_total=len(frames))
+        for i, v in enumerate(videos):
+            if v["selected"]:
+                v["progress"].stage_started("analyze")
+                batch.set_job_status(i, "running")
+
+        token = _current_telemetry.set(batch_telemetry)
+        try:
+            with batch_telemetry.stage("analyze"):
+                if mode == "offline":
+                    custom_ids = [f"{videos[i]['job_id']}:{n}" for i, n in pooled]
+                    results, openai_batch = submit_frames_offline(frames, cache_keys, custom_ids, batch)
+                else:
+                    results, openai_batch = analyze_frames(frames, cache_keys), None
+        finally:
+            _current_telemetry.reset(token)
+
+        if openai_batch is not None:
+            _save_offline_state(batch, videos, pooled, frames, cache_keys, custom_ids, results, openai_batch)
+            return
+
+        _complete_batch(batch, videos, pooled, results, batch_telemetry)
+    except PipelineError as e:
+        _fail_batch(batch, videos, e.message, e.status_code)
+    except Exception as e:
+        print(f"❌ Unexpected error in batch {batch_id}: {e}")
+        _fail_batch(batch, videos, f"Internal server error: {str(e)}")
+    finally:
+        for v in videos:
+            if v["video_path"].exists():
+                v["video_path"].unlink()
+            if v["frames_dir"] and v["frames_dir"].exists():
+                shutil.rmtree(v["frames_dir"], ignore_errors=True)
+
+
+def _save_offline_state(
+    batch: BatchProgress,
+    videos: List[Dict],
+    pooled: List[Tuple[int, int]],
+    frames: List[Tuple[Frame, float]],
+    cache_keys: List[Optional[str]],
+    custom_ids: List[str],
+    results: List[Optional[Dict]],
+    openai_batch,
+) -> None:
+    """
+    Persist what poll_offline_batch needs to finish a submitted batch in any
+    worker, even after a restart, and settle the videos that need no analysis.
+    """
+    for i, v in enumerate(videos):
+        if v["payload"] is not None or v["error"] is not None:
+            _report_batch_video(batch, i, v)
+        else:
+            # Finished by whichever worker polls the batch, not this one
+            v["progress"].detach()
+
+    state = {
+        "submitted_at": time.time(),
+        "deadline": time.time() + OFFLINE_BATCH_MAX_WAIT_SECONDS,
+        "videos": [
+            {
+                "content_hash": v["content_hash"],
+                "video_filename": v["video_path"].name,
+                "frames": v["frames"],
+                "stages": dict(v["telemetry"].stages),
+                "usage": dict(v["telemetry"].usage),
+            }
+            for v in videos
+        ],
+        "frames": [
+            {
+                "custom_id": custom_id,
+                "video": i,
+                "timestamp": timestamp_sec,
+                "frame_file": frame_label(frame, timestamp_sec),
+                "cache_key": cache_key,
+                "analysis": analysis,
+            }
+            for (i, _), (frame, timestamp_sec), cache_key, custom_id, analysis in zip(
+                pooled, frames, cache_keys, custom_ids, results
+            )
+        ],
+    }
+    batch.update(status="submitted", owner=None, openai_polled_at=time.time(), _offline=state)
+    print(f"📦 Batch {batch.record['job_id']} waiting on OpenAI batch {openai_batch.id}")
+
+
+def _resume_batch_videos(record: Dict) -> List[Dict]:
+    """Rebuild run_analysis_batch's per-video state from a submitted batch record."""
+    videos = []
+    for job, saved in zip(record["jobs"], record["_offline"]["videos"]):
+        progress = JobProgress(job["job_id"])
+        progress.record = load_job(job["job_id"]) or progress.record
+        telemetry = JobTelemetry(started_at=record["created_at"])
+        telemetry.stages.update(saved["stages"])
+        telemetry.usage.update(saved["usage"])
+        status = progress.record["status"]
+        videos.append(
+            {
+                "job_id": job["job_id"],
+                "storage_path": job["videoPath"],
+                "bucket": job["bucket"],
+                "video_path": UPLOAD_FOLDER / saved["video_filename"],
+                "content_hash": saved["content_hash"],
+                "frames": saved["frames"],
+                "progress": progress,
+                "telemetry": telemetry,
+                "payload": progress.record["result"] if status == "completed" else None,
+                "outcome": "ok",
+                "error": (
+                    {"error": progress.record["error"], "status": progress.record.get("error_status", 500)}
+                    if status == "failed" else None
+                ),
+                "reported": status in ("completed", "failed"),
+            }
+        )
+    return videos
+
+
+def _claim_offline_batch(batch_id: str) -> bool:
+    """
+    Take the lock file for a submitted batch so one worker on the host polls and
+    finishes it. A lock older than OFFLINE_BATCH_CLAIM_SECONDS belonged to a worker
+    that died and is taken over.
+    """
+    lock_path = JOBS_FOLDER / f"{batch_id}.lock"
+    for _ in range(2):
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - lock_path.stat().st_mtime < OFFLINE_BATCH_CLAIM_SECONDS:
+                    return False
+                lock_path.unlink()
+            except FileNotFoundError:
+                continue
+    return False
+
+
+def _release_offline_batch(batch_id: str) -> None:
+    try:
+        (JOBS_FOLDER / f"{batch_id}.lock").unlink()
+    except FileNotFoundError:
+        pass
+
+
+def poll_offline_batch(batch_id: str) -> None:
+    """
+    Check a submitted offline batch on OpenAI (at most every OFFLINE_BATCH_POLL_SECONDS)
+    and, once it has finished, map its output onto the frames and summarize each
+    video. Batches still running after OFFLINE_BATCH_MAX_WAIT_SECONDS are cancelled.
+    """
+    record = load_job(batch_id)
+    if not record or record.get("status") != "submitted":
+        return
+    if time.time() - (record.get("openai_polled_at") or 0) < OFFLINE_BATCH_POLL_SECONDS:
+        return
+    if not _claim_offline_batch(batch_id):
+        return
+
+    try:
+        # Another worker may have finished it between the read and the claim
+        record = load_job(batch_id)
+        if not record or record.get("status") != "submitted":
+            return
+        batch = BatchProgress.from_record(record)
+        openai_client = get_openai_client()
+        openai_batch = openai_client.batches.retrieve(record["openai_batch_id"])
+        batch.update(openai_batch_status=openai_batch.status, openai_polled_at=time.time())
+        # Keep the per-video records from being pruned while the batch waits
+        for job in record["jobs"]:
+            try:
+                os.utime(_job_file(job["job_id"]))
+            except FileNotFoundError:
+                pass
+
+        if openai_batch.status not in ("completed", "failed", "expired", "cancelled"):
+            if time.time() > record["_offline"]["deadline"]:
+                openai_client.batches.cancel(openai_batch.id)
+                _fail_batch(
+                    batch, _resume_batch_videos(record),
+                    f"OpenAI batch {openai_batch.id} did not finish in time", 504,
+                )
+            return
+
+        videos = _resume_batch_videos(record)
+        batch_telemetry = JobTelemetry(started_at=record["created_at"])
+        batch_telemetry.stages["analyze"] = round(time.time() - record["_offline"]["submitted_at"], 3)
+        pooled = [(f["video"], n) for n, f in enumerate(record["_offline"]["frames"])]
+        try:
+            token = _current_telemetry.set(batch_telemetry)
+            try:
+                results = collect_offline_results(openai_batch, record["_offline"]["frames"])
+            finally:
+                _current_telemetry.reset(token)
+            _complete_batch(batch, videos, pooled, results, batch_telemetry)
+        except PipelineError as e:
+            _fail_batch(batch, videos, e.message, e.status_code)
+        except Exception as e:
+            print(f"❌ Unexpected error finishing batch {batch_id}: {e}")
+            _fail_batch(batch, videos, f"Internal server error: {str(e)}")
+    finally:
+        _release_offline_batch(batch_id)
+
+
+_offline_poller_pid = None
+
+
+def _offline_poller() -> None:
+    while True:
+        for path in JOBS_FOLDER.glob("*.json"):
+            try:
+                poll_offline_batch(path.stem)
+            except Exception as e:
+                print(f"⚠️ Error polling offline batch {path.stem}: {e}")
+        time.sleep(OFFLINE_BATCH_POLL_SECONDS)
+
+
+def _ensure_offline_poller() -> None:
+    """Start the offline batch poller lazily, once per process (safe across forks)."""
+    global _offline_poller_pid
+    with _job_workers_lock:
+        if _offline_poller_pid != os.getpid():
+            threading.Thread(target=_offline_poller, name="offline-batch-poller", daemon=True).start()
+            _offline_poller_pid = os.getpid()
+
+
+# ---------- routes ----------
+
+
+@app.route("/")
+def health():
+    return jsonify({"status": "ok"})
+
+
+@app.route("/upload", methods=["POST"])
+def upload():
+    """
+    Accepts JSON with 'videoPath' pointing to a video in Supabase Storage
+    (optional 'bucket', default "submission-videos").
+    Returns JSON:
+
+      {
+        "job_id": str,
+        "video_filename": str,
+        "frame_analyses": [...],
+        "metrics": {...},
+        "feedback": str,
+        "final_summary": str
+      }
+
+    With "async": true (or ?async=1) the job is queued instead and the route
+    replies 202 with the job_id; poll GET /jobs/<job_id> for the result.
+    """
+    job_id = None
+
+    try:
+        data = request.get_json()
+
+        if not data or "videoPath" not in data:
+            return jsonify({"error": "No 'videoPath' in request"}), 400
+
+        storage_path = data["videoPath"]
+        bucket = data.get("bucket") or "submission-videos"
+        job_id = str(uuid.uuid4())
+
+        if _wants_async(data):
+            if not enqueue_analysis_job(job_id, bucket, storage_path):
+                resp = jsonify({"error": "Job queue is full, retry later"})
+                resp.headers["Retry-After"] = str(JOB_RETRY_AFTER_SECONDS)
+                return resp, 429
+            print(f"📥 Queued job {job_id}: {bucket}/{storage_path}")
+            return jsonify({"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}), 202
+
+        return jsonify(run_analysis_pipeline(job_id, bucket, storage_path))
+
+    except PipelineError as e:
+        return jsonify({"error": e.message}), e.status_code
+
     except Exception as e:
         print(f"❌ Unexpected error in /upload: {e}")
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
-    
-    finally:
-        # Cleanup temporary files after processing
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route("/upload/stream", methods=["POST"])
+def upload_stream():
+    """
+    Same input as /upload, answered as Server-Sent Events while the job runs:
+    job, download, frames (count), one frame event per analysis as its vision call
+    returns, feedback_delta (with SUMMARY_STREAM), then result with the /upload
+    payload, or error. A client disconnect cancels the remaining vision calls.
+    """
+    data = request.get_json(silent=True)
+    if not data or "videoPath" not in data:
+        return jsonify({"error": "No 'videoPath' in request"}), 400
+
+    storage_path = data["videoPath"]
+    bucket = data.get("bucket") or "submission-videos"
+    job_id = str(uuid.uuid4())
+    events: "queue.Queue" = queue.Queue()
+    progress = StreamingProgress(job_id, events)
+
+    def _run():
         try:
-            if video_path and video_path.exists():
-                video_path.unlink()
-                print(f"🧹 Cleaned up video: {video_path}")
-            if frames_dir and frames_dir.exists():
-                shutil.rmtree(frames_dir, ignore_errors=True)
-                print(f"🧹 Cleaned up frames: {frames_dir}")
+            events.put(("result", run_analysis_pipeline(job_id, bucket, storage_path, progress)))
+        except PipelineError as e:
+            events.put(("error", {"error": e.message, "status": e.status_code}))
         except Exception as e:
-            print(f"⚠️ Warning: Error cleaning up files: {e}")
+            print(f"❌ Unexpected error in /upload/stream: {e}")
+            events.put(("error", {"error": f"Internal server error: {str(e)}", "status": 500}))
+        finally:
+            events.put(None)
+
+    threading.Thread(target=_run, name=f"sse-{job_id}", daemon=True).start()
+
+    def _generate():
+        finished = False
+        try:
+            yield _sse("job", {"job_id": job_id})
+            while True:
+                try:
+                    item = events.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    # Comment line; also how a dropped client gets noticed between events
+                    yield ": keep-alive\n\n"
+                    continue
+                if item is None:
+                    finished = True
+                    return
+                yield _sse(*item)
+        finally:
+            if not finished:
+                print(f"🔌 Client disconnected from /upload/stream, cancelling job {job_id}")
+                progress.cancel_event.set()
+
+    return Response(
+        _generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/upload/batch", methods=["POST"])
+def upload_batch():
+    """
+    Accepts JSON {"videos": [{"videoPath": str, "bucket": str}, ...], "mode": "online" | "offline"}.
+    Queues one batch job and replies 202 with its batch_id and a job_id per video.
+    Poll GET /jobs/<batch_id> for the batch, or GET /jobs/<job_id> per video.
+    "offline" sends the vision requests through the OpenAI Batch API (cheaper, no
+    rate limits, results within 24h).
+    """
+    data = request.get_json(silent=True)
+    videos = data.get("videos") if data else None
+    if not isinstance(videos, list) or not videos:
+        return jsonify({"error": "No 'videos' list in request"}), 400
+    if len(videos) > BATCH_MAX_VIDEOS:
+        return jsonify({"error": f"At most {BATCH_MAX_VIDEOS} videos per batch"}), 400
+    for n, video in enumerate(videos):
+        if not isinstance(video, dict) or "videoPath" not in video:
+            return jsonify({"error": f"No 'videoPath' in videos[{n}]"}), 400
+
+    mode = data.get("mode") or "online"
+    if mode not in ("online", "offline"):
+        return jsonify({"error": "'mode' must be 'online' or 'offline'"}), 400
+
+    batch_id = str(uuid.uuid4())
+    items = [
+        {
+            "job_id": str(uuid.uuid4()),
+            "storage_path": video["videoPath"],
+            "bucket": video.get("bucket") or "submission-videos",
+        }
+        for video in videos
+    ]
+    for item in items:
+        item["progress"] = JobProgress(item["job_id"])
+    batch = BatchProgress(batch_id, items, mode)
+    if mode == "offline":
+        _ensure_offline_poller()
+
+    if not enqueue_job(lambda: run_analysis_batch(batch, items, mode)):
+        resp = jsonify({"error": "Job queue is full, retry later"})
+        resp.headers["Retry-After"] = str(JOB_RETRY_AFTER_SECONDS)
+        return resp, 429
+
+    batch.update(owner=_worker_id)
+    for item in items:
+        item["progress"].queued()
+    print(f"📥 Queued {mode} batch {batch_id} with {len(items)} videos")
+    return jsonify({
+        "batch_id": batch_id,
+        "status": "queued",
+        "status_url": f"/jobs/{batch_id}",
+        "jobs": [
+            {"job_id": item["job_id"], "videoPath": item["storage_path"], "status_url": f"/jobs/{item['job_id']}"}
+            for item in items
+        ],
+    }), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id: str):
+    """Status, per-stage progress and (once completed) the /upload payload of an async job."""
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        return jsonify({"error": "Invalid job id"}), 400
+
+    # A restarted worker picks up submitted offline batches from here on
+    _ensure_offline_poller()
+    record = load_job(job_id)
+    if record is None:
+        return jsonify({"error": "Job not found"}), 404
+    record = fail_orphaned_job(record)
+    return jsonify({key: value for key, value in record.items() if not key.startswith("_")})
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_route():
+    """Prometheus text-format metrics, aggregated across all workers on the host."""
+    if not METRICS_ENABLED:
+        return Response("# metrics disabled\n", mimetype="text/plain")
+    try:
+        return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+    except sqlite3.Error as e:
+        return Response(f"# metrics unavailable: {e}\n", status=500, mimetype="text/plain")
+
+
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats_route():
+    """Hit/miss counts and size of the analysis cache."""
+    if not CACHE_ENABLED:
+        return jsonify({"enabled": False})
+    try:
+        return jsonify({"enabled": True, **cache_stats()})
+    except sqlite3.Error as e:
+        return jsonify({"error": f"Cache unavailable: {e}"}), 500
 
 
 if __name__ == "__main__":
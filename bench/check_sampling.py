@@ -0,0 +1,87 @@
+"""
+Check that seek-based extraction picks the same frames as decoding the whole video.
+
+For every --durations x --video-fps clip (ffmpeg testsrc, rendered like
+bench/run_bench.py does) and every --fps x --max-frames setting, compares
+app.sample_timestamps(app.probe_duration(clip), fps, max_frames) with the
+timestamps app.extract_frames at `fps` followed by np.linspace sampling picks.
+The default durations are mostly fractional, where ffmpeg's rounding of the
+frame count matters. Prints each mismatch and exits 1 if there is any:
+
+    python bench/check_sampling.py
+    python bench/check_sampling.py --durations 8.9,9.5 --fps 0.5
+
+Requires ffmpeg/ffprobe on PATH.
+"""
+
+import argparse
+import sys
+import tempfile
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from run_bench import DATA_DIR, BUCKET, generate_videos  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--durations", default="8.9,9.5,10,12.3,30.25,61.7",
+                        help="Clip lengths in seconds (default: 8.9,9.5,10,12.3,30.25,61.7)")
+    parser.add_argument("--video-fps", default="24,25,30", help="Clip frame rates (default: 24,25,30)")
+    parser.add_argument("--resolution", default="320x240", help="Clip size (default: 320x240)")
+    parser.add_argument("--fps", default="0.5,1,2", help="Sampling rates to check (default: 0.5,1,2)")
+    parser.add_argument("--max-frames", default="3,6,12", help="Frame budgets to check (default: 3,6,12)")
+    return parser.parse_args()
+
+
+def decoded_timestamps(fps: float, max_frames: int, frame_count: int) -> List[float]:
+    """What select_frames' decoding fallback picks from `frame_count` frames extracted at fps."""
+    num_frames_to_use = min(max_frames, frame_count)
+    indices = np.linspace(0, frame_count - 1, num_frames_to_use, dtype=int)
+    return [i / float(fps) for i in indices]
+
+
+def main() -> None:
+    args = parse_args()
+    durations = [float(d) for d in args.durations.split(",")]
+    rates = [float(f) for f in args.fps.split(",")]
+    budgets = [int(n) for n in args.max_frames.split(",")]
+
+    videos = []
+    for video_fps in (int(f) for f in args.video_fps.split(",")):
+        videos.extend(generate_videos(durations, [args.resolution], video_fps))
+
+    import app as app_module
+
+    checked = 0
+    mismatches = 0
+    for video in videos:
+        video_path = DATA_DIR / "storage" / BUCKET / video["name"]
+        duration = app_module.probe_duration(video_path)
+        for fps in rates:
+            with tempfile.TemporaryDirectory() as tmp:
+                frame_count = len(app_module.extract_frames(video_path, Path(tmp), fps=fps))
+            for max_frames in budgets:
+                checked += 1
+                expected = decoded_timestamps(fps, max_frames, frame_count)
+                sampled = app_module.sample_timestamps(duration, fps, max_frames)
+                if len(expected) == len(sampled) and np.allclose(expected, sampled):
+                    continue
+                mismatches += 1
+                print(
+                    f"MISMATCH {video['name']} (probed {duration:.6f}s, ffmpeg emitted {frame_count} frames) "
+                    f"fps={fps:g} max_frames={max_frames}: decoded {expected} vs sampled {sampled}"
+                )
+
+    print(f"{checked - mismatches}/{checked} settings match", file=sys.stderr)
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
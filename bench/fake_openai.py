@@ -0,0 +1,430 @@
+"""
+Local stand-in for the parts of the OpenAI API that app.py uses:
+- POST /v1/chat/completions (single-frame, multi-frame and summary requests; stream=true)
+- POST /v1/files, GET /v1/files/<id>/content
+- POST /v1/batches, GET /v1/batches/<id>, POST /v1/batches/<id>/cancel
+
+Replies are deterministic JSON in the shapes app.py asks for, with a "usage" block
+that bills images by size and detail level the way OpenAI does.
+Batches complete FAKE_BATCH_SECONDS after they are created.
+
+Chat completions are held to FAKE_RPM_LIMIT / FAKE_TPM_LIMIT per model
+(0 = unlimited), counting prompt tokens plus max_tokens the way OpenAI does,
+and answer with x-ratelimit-* headers, or 429 and retry-after-ms.
+FAKE_429_RATE additionally rejects that fraction of requests at random, and
+FAKE_MALFORMED_RATE mangles that fraction of JSON replies the way models do
+(code fences, chatty text, single quotes, trailing commas, or cut short).
+
+Each completion takes FAKE_LATENCY_MS, plus FAKE_LATENCY_PER_IMAGE_MS per image,
+plus FAKE_LATENCY_PER_1K_TOKENS_MS per 1000 prompt tokens,
+plus up to FAKE_LATENCY_JITTER_MS (seeded by FAKE_SEED).
+GET /stats returns request, 429 and token totals per model; POST /stats/reset clears them.
+
+Run:
+    python bench/fake_openai.py            # listens on 127.0.0.1:8089
+    OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_API_KEY=test python app.py
+"""
+
+import base64
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+
+from flask import Flask, Response, jsonify, request
+
+FAKE_BATCH_SECONDS = float(os.environ.get("FAKE_BATCH_SECONDS", 2))
+FAKE_RPM_LIMIT = int(os.environ.get("FAKE_RPM_LIMIT", 0))
+FAKE_TPM_LIMIT = int(os.environ.get("FAKE_TPM_LIMIT", 0))
+FAKE_429_RATE = float(os.environ.get("FAKE_429_RATE", 0))
+FAKE_MALFORMED_RATE = float(os.environ.get("FAKE_MALFORMED_RATE", 0))
+FAKE_LATENCY_MS = float(os.environ.get("FAKE_LATENCY_MS", 0))
+FAKE_LATENCY_PER_IMAGE_MS = float(os.environ.get("FAKE_LATENCY_PER_IMAGE_MS", 0))
+FAKE_LATENCY_JITTER_MS = float(os.environ.get("FAKE_LATENCY_JITTER_MS", 0))
+FAKE_LATENCY_PER_1K_TOKENS_MS = float(os.environ.get("FAKE_LATENCY_PER_1K_TOKENS_MS", 0))
+IMAGE_TOKEN_COSTS = {"gpt-4o-mini": (2833, 5667)}  # (base, per 512px tile); others 85, 170
+
+app = Flask(__name__)
+
+_lock = threading.Lock()
+_files = {}
+_batches = {}
+_buckets = {}  # model -> remaining requests/tokens
+_stats = {}  # model -> request, 429 and token totals
+_random = random.Random(int(os.environ.get("FAKE_SEED", 0)))
+
+
+def _text_parts(messages):
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            yield content
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    yield part.get("text", "")
+
+
+def _image_parts(messages):
+    for message in messages:
+        if isinstance(message.get("content"), list):
+            for part in message["content"]:
+                if part.get("type") == "image_url":
+                    yield part.get("image_url") or {}
+
+
+def _count_images(messages):
+    return sum(1 for _ in _image_parts(messages))
+
+
+def _jpeg_size(data):
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return int.from_bytes(data[i + 7 : i + 9], "big"), int.from_bytes(data[i + 5 : i + 7], "big")
+        i += 2 + int.from_bytes(data[i + 2 : i + 4], "big")
+    return None
+
+
+def image_tokens(image_url, model):
+    """What OpenAI bills for an image: base at detail=low, else base plus a charge per 512px tile."""
+    base, per_tile = IMAGE_TOKEN_COSTS.get(model, (85, 170))
+    url = image_url.get("url", "")
+    size = None
+    if url.startswith("data:image/jpeg;base64,"):
+        try:
+            size = _jpeg_size(base64.b64decode(url.split(",", 1)[1]))
+        except ValueError:
+            pass
+    if image_url.get("detail") == "low" or size is None:
+        return base
+    width, height = size
+    scale = min(1.0, 2048 / max(width, height), 768 / min(width, height))
+    return base + per_tile * math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+
+
+def _frame_analysis(timestamp):
+    return {
+        "timestamp": timestamp,
+        "description": "Trainee drives a screw into the workpiece with a cordless driver.",
+        "errors": ["Driver is tilted slightly off axis"] if int(timestamp) % 2 else [],
+        "safety_issues": ["No gloves"],
+        "skill_score": 83,
+    }
+
+
+def reply_content(body):
+    """The assistant message content for a chat completion request body."""
+    messages = body.get("messages") or []
+    texts = list(_text_parts(messages))
+    if any(m.get("role") == "system" for m in messages):
+        feedback = (
+            "## Overall assessment\nSteady, controlled work.\n\n"
+            "## Key strengths\n- Consistent grip\n\n"
+            "## Recurring mistakes\n- Driver tilts off axis\n\n"
+            "## Safety issues\n- No gloves\n\n"
+            "## Next steps for practice\n1. Keep the driver square to the surface"
+        )
+        if body.get("stream"):
+            return feedback
+        return json.dumps({"feedback": feedback})
+
+    timestamps = [float(t) for t in re.findall(r"Frame at timestamp ([0-9.]+)s:", "\n".join(texts))]
+    if timestamps:
+        return json.dumps({"frames": [_frame_analysis(t) for t in timestamps]})
+
+    match = re.search(r"from the start of the video \(([0-9.]+)\)", "\n".join(texts))
+    return json.dumps(_frame_analysis(float(match.group(1)) if match else 0.0))
+
+
+def malform(content):
+    """A JSON reply as a model sometimes gets it wrong; only the cut-short one can't be repaired."""
+    with _lock:
+        if not (FAKE_MALFORMED_RATE > 0 and _random.random() < FAKE_MALFORMED_RATE):
+            return content
+        kind = _random.choice(["fence", "chatty", "single_quotes", "trailing_comma", "truncated"])
+    if kind == "fence":
+        return f"```json\n{content}\n```"
+    if kind == "chatty":
+        return f"Here is the analysis:\n{content}\nLet me know if you need anything else."
+    if kind == "single_quotes":
+        return repr(json.loads(content))
+    if kind == "trailing_comma":
+        return content[:-1] + ",}"
+    return content[: len(content) // 2]
+
+
+def usage_for(body, content):
+    model = body.get("model", "gpt-4o-mini")
+    prompt_tokens = sum(len(t) // 4 for t in _text_parts(body.get("messages") or []))
+    prompt_tokens += sum(image_tokens(part, model) for part in _image_parts(body.get("messages") or []))
+    completion_tokens = max(1, len(content) // 4)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def _format_reset(seconds):
+    return f"{max(seconds, 0.001):.3f}s"
+
+
+def admit(body):
+    """
+    Count a request against the per-model limits. Like OpenAI's limiter, each
+    limit is a bucket that holds one minute's allowance and refills continuously.
+    Returns (headers, retry_after); retry_after is None when the request is admitted.
+    """
+    model = body.get("model", "gpt-4o-mini")
+    cost = usage_for(body, "")["prompt_tokens"] + (body.get("max_tokens") or 0)
+    now = time.time()
+    with _lock:
+        state = _buckets.setdefault(model, {"requests": FAKE_RPM_LIMIT, "tokens": FAKE_TPM_LIMIT, "updated": now})
+        elapsed = now - state["updated"]
+        state["requests"] = min(FAKE_RPM_LIMIT, state["requests"] + elapsed * FAKE_RPM_LIMIT / 60)
+        state["tokens"] = min(FAKE_TPM_LIMIT, state["tokens"] + elapsed * FAKE_TPM_LIMIT / 60)
+        state["updated"] = now
+
+        retry_after = None
+        if FAKE_RPM_LIMIT and state["requests"] < 1:
+            retry_after = (1 - state["requests"]) * 60 / FAKE_RPM_LIMIT
+        elif FAKE_TPM_LIMIT and state["tokens"] < cost:
+            retry_after = (cost - state["tokens"]) * 60 / FAKE_TPM_LIMIT
+        else:
+            state["requests"] -= 1
+            state["tokens"] -= cost
+        requests_left, tokens_left = state["requests"], state["tokens"]
+
+    headers = {}
+    if FAKE_RPM_LIMIT:
+        headers["x-ratelimit-limit-requests"] = str(FAKE_RPM_LIMIT)
+        headers["x-ratelimit-remaining-requests"] = str(int(requests_left))
+        headers["x-ratelimit-reset-requests"] = _format_reset((FAKE_RPM_LIMIT - requests_left) * 60 / FAKE_RPM_LIMIT)
+    if FAKE_TPM_LIMIT:
+        headers["x-ratelimit-limit-tokens"] = str(FAKE_TPM_LIMIT)
+        headers["x-ratelimit-remaining-tokens"] = str(int(tokens_left))
+        headers["x-ratelimit-reset-tokens"] = _format_reset((FAKE_TPM_LIMIT - tokens_left) * 60 / FAKE_TPM_LIMIT)
+    if retry_after is not None:
+        headers["retry-after-ms"] = str(int(retry_after * 1000) + 1)
+    return headers, retry_after
+
+
+def _record(model, **counts):
+    with _lock:
+        stats = _stats.setdefault(model, {
+            "requests": 0,
+            "rate_limited": 0,
+            "injected_429": 0,
+            "images": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0,
+        })
+        for key, value in counts.items():
+            stats[key] += value
+
+
+def _latency(body):
+    """Seconds a completion for this request takes."""
+    with _lock:
+        jitter = _random.uniform(0, FAKE_LATENCY_JITTER_MS)
+    images = _count_images(body.get("messages") or [])
+    prompt_tokens = usage_for(body, "")["prompt_tokens"] if FAKE_LATENCY_PER_1K_TOKENS_MS else 0
+    per_tokens = FAKE_LATENCY_PER_1K_TOKENS_MS * prompt_tokens / 1000
+    return (FAKE_LATENCY_MS + FAKE_LATENCY_PER_IMAGE_MS * images + per_tokens + jitter) / 1000
+
+
+def completion(body):
+    content = malform(reply_content(body))
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-4o-mini"),
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": usage_for(body, content),
+    }
+
+
+def _stream(body):
+    content = reply_content(body)
+    base = {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-4o-mini"),
+    }
+    for n in range(0, len(content), 40):
+        chunk = dict(base, choices=[{"index": 0, "delta": {"content": content[n : n + 40]}, "finish_reason": None}])
+        yield f"data: {json.dumps(chunk)}\n\n"
+    chunk = dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+    if (body.get("stream_options") or {}).get("include_usage"):
+        yield f"data: {json.dumps(chunk)}\n\n"
+        chunk = dict(base, choices=[], usage=usage_for(body, content))
+    yield f"data: {json.dumps(chunk)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.route("/v1/chat/completions", methods=["POST"])
+def chat_completions():
+    body = request.get_json()
+    model = body.get("model", "gpt-4o-mini")
+    with _lock:
+        injected = FAKE_429_RATE > 0 and _random.random() < FAKE_429_RATE
+    if injected:
+        _record(model, requests=1, injected_429=1)
+        headers = {"retry-after-ms": str(_random.randint(100, 1000))}
+    else:
+        headers, retry_after = admit(body)
+        if retry_after is not None:
+            _record(model, requests=1, rate_limited=1)
+    if injected or retry_after is not None:
+        error = {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}
+        return jsonify(error), 429, headers
+
+    time.sleep(_latency(body))
+    if body.get("stream"):
+        content = reply_content(body)
+        _record(model, requests=1, images=_count_images(body["messages"]), **usage_for(body, content))
+        return Response(_stream(body), mimetype="text/event-stream", headers=headers)
+    reply = completion(body)
+    _record(model, requests=1, images=_count_images(body["messages"]), **reply["usage"])
+    return jsonify(reply), 200, headers
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    with _lock:
+        return jsonify({model: dict(counts) for model, counts in _stats.items()})
+
+
+@app.route("/stats/reset", methods=["POST"])
+def reset_stats():
+    with _lock:
+        _stats.clear()
+    return jsonify({"ok": True})
+
+
+@app.route("/v1/files", methods=["POST"])
+def create_file():
+    upload = request.files["file"]
+    file_id = f"file-{uuid.uuid4().hex[:12]}"
+    data = upload.read()
+    with _lock:
+        _files[file_id] = data
+    return jsonify({
+        "id": file_id,
+        "object": "file",
+        "bytes": len(data),
+        "created_at": int(time.time()),
+        "filename": upload.filename,
+        "purpose": request.form.get("purpose", "batch"),
+        "status": "processed",
+    })
+
+
+@app.route("/v1/files/<file_id>/content", methods=["GET"])
+def file_content(file_id):
+    with _lock:
+        data = _files.get(file_id)
+    if data is None:
+        return jsonify({"error": {"message": "No such file"}}), 404
+    return Response(data, mimetype="application/jsonl")
+
+
+def _run_batch(batch_id):
+    with _lock:
+        batch = _batches[batch_id]
+        lines = _files[batch["input_file_id"]].decode("utf-8").splitlines()
+    output = []
+    for raw_line in lines:
+        if not raw_line.strip():
+            continue
+        line = json.loads(raw_line)
+        output.append(json.dumps({
+            "id": f"batch_req_{uuid.uuid4().hex[:12]}",
+            "custom_id": line["custom_id"],
+            "response": {
+                "status_code": 200,
+                "request_id": uuid.uuid4().hex,
+                "body": completion(line["body"]),
+            },
+            "error": None,
+        }))
+    output_file_id = f"file-{uuid.uuid4().hex[:12]}"
+    with _lock:
+        _files[output_file_id] = "\n".join(output).encode("utf-8")
+        batch["output_file_id"] = output_file_id
+        batch["request_counts"] = {"total": len(output), "completed": len(output), "failed": 0}
+
+
+def _batch_view(batch):
+    # Resolve the batch lazily once its fake processing time has passed
+    if batch["status"] == "in_progress" and time.time() >= batch["created_at"] + FAKE_BATCH_SECONDS:
+        _run_batch(batch["id"])
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+    return jsonify(batch)
+
+
+@app.route("/v1/batches", methods=["POST"])
+def create_batch():
+    body = request.get_json()
+    if body.get("input_file_id") not in _files:
+        return jsonify({"error": {"message": "No such file"}}), 404
+    batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+    batch = {
+        "id": batch_id,
+        "object": "batch",
+        "endpoint": body.get("endpoint"),
+        "input_file_id": body["input_file_id"],
+        "completion_window": body.get("completion_window", "24h"),
+        "status": "in_progress",
+        "output_file_id": None,
+        "error_file_id": None,
+        "created_at": int(time.time()),
+        "metadata": body.get("metadata"),
+        "request_counts": {"total": 0, "completed": 0, "failed": 0},
+    }
+    with _lock:
+        _batches[batch_id] = batch
+    return jsonify(batch)
+
+
+@app.route("/v1/batches/<batch_id>", methods=["GET"])
+def retrieve_batch(batch_id):
+    batch = _batches.get(batch_id)
+    if batch is None:
+        return jsonify({"error": {"message": "No such batch"}}), 404
+    return _batch_view(batch)
+
+
+@app.route("/v1/batches/<batch_id>/cancel", methods=["POST"])
+def cancel_batch(batch_id):
+    batch = _batches.get(batch_id)
+    if batch is None:
+        return jsonify({"error": {"message": "No such batch"}}), 404
+    batch["status"] = "cancelled"
+    return jsonify(batch)
+
+
+if __name__ == "__main__":
+    port = int(os.environ.get("FAKE_OPENAI_PORT", 8089))
+    app.run(host="127.0.0.1", port=port, threaded=True)
@@ -0,0 +1,89 @@
+"""
+Local stand-in for Supabase Storage signed URLs:
+- POST /storage/v1/object/sign/<bucket>/<path>  -> {"signedURL": "/object/sign/<bucket>/<path>?token=..."}
+- GET/HEAD /storage/v1/object/sign/<bucket>/<path>?token=...  (ETag, Content-Length, Range)
+
+Objects are files under FAKE_STORAGE_ROOT/<bucket>/<path>. FAKE_STORAGE_BANDWIDTH
+(bytes/sec per download, 0 = unlimited) throttles the body to mimic a remote store.
+
+Run:
+    FAKE_STORAGE_ROOT=bench/.data/storage python bench/fake_storage.py   # 127.0.0.1:8088
+    SUPABASE_URL=http://127.0.0.1:8088 SUPABASE_SERVICE_ROLE_KEY=test python app.py
+"""
+
+import hashlib
+import os
+import re
+import time
+import uuid
+from pathlib import Path
+
+from flask import Flask, Response, abort, jsonify, request
+
+FAKE_STORAGE_ROOT = Path(os.environ.get("FAKE_STORAGE_ROOT", "bench/.data/storage")).resolve()
+FAKE_STORAGE_BANDWIDTH = int(os.environ.get("FAKE_STORAGE_BANDWIDTH", 0))
+CHUNK_SIZE = 256 * 1024
+
+app = Flask(__name__)
+
+
+def _object_path(bucket, path):
+    full = (FAKE_STORAGE_ROOT / bucket / path).resolve()
+    if FAKE_STORAGE_ROOT not in full.parents or not full.is_file():
+        return None
+    return full
+
+
+@app.route("/storage/v1/object/sign/<bucket>/<path:path>", methods=["POST"])
+def sign(bucket, path):
+    if _object_path(bucket, path) is None:
+        return jsonify({"statusCode": "404", "error": "not_found", "message": "Object not found"}), 400
+    return jsonify({"signedURL": f"/object/sign/{bucket}/{path}?token={uuid.uuid4().hex}"})
+
+
+def _body(full, start, end):
+    with open(full, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            if FAKE_STORAGE_BANDWIDTH:
+                time.sleep(len(chunk) / FAKE_STORAGE_BANDWIDTH)
+            yield chunk
+
+
+@app.route("/storage/v1/object/sign/<bucket>/<path:path>", methods=["GET", "HEAD"])
+def download(bucket, path):
+    if not request.args.get("token"):
+        abort(400)
+    full = _object_path(bucket, path)
+    if full is None:
+        abort(404)
+
+    stat = full.stat()
+    size = stat.st_size
+    etag = hashlib.md5(f"{full}:{size}:{stat.st_mtime_ns}".encode()).hexdigest()
+    headers = {"ETag": f'"{etag}"', "Accept-Ranges": "bytes", "Content-Type": "video/mp4"}
+
+    start, end, status = 0, size - 1, 200
+    match = re.fullmatch(r"bytes=(\d+)-(\d*)", request.headers.get("Range", ""))
+    if match:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        if start >= size:
+            return Response(status=416, headers={"Content-Range": f"bytes */{size}"})
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+
+    if request.method == "HEAD":
+        return Response(status=status, headers=headers)
+    return Response(_body(full, start, end), status=status, headers=headers)
+
+
+if __name__ == "__main__":
+    port = int(os.environ.get("FAKE_STORAGE_PORT", 8088))
+    app.run(host="127.0.0.1", port=port, threaded=True)
@@ -0,0 +1,534 @@
+"""
+Benchmark the /upload pipeline end to end against local stand-ins.
+
+- Synthetic videos (ffmpeg testsrc) of every --durations x --resolutions combination
+- bench/fake_storage.py serves them as Supabase Storage signed URLs
+- bench/fake_openai.py answers the chat completions (latency, 429s, token counts)
+- app.upload is driven in-process at each --concurrency level
+
+Reports, per concurrency level: p50/p95 job latency, jobs/minute, frames,
+vision calls, prompt tokens and JSON repairs/retries/fallbacks per job, the spread of each video's scores
+across its jobs, peak RSS,
+and per pipeline stage its p50/p95 time, peak RSS and peak temp disk (bytes under
+uploads/ and frames/ while that stage was running). Results are JSON so runs
+can be compared across commits:
+
+    python bench/run_bench.py --out bench/results/before.json
+    python bench/run_bench.py --out bench/results/after.json --baseline bench/results/before.json
+
+Service settings come from the environment as usual (e.g. FRAME_SELECTION_MODE=scene);
+the result cache is off unless --cache is given, so every job does the full work.
+The fake server's scores are fixed; to check that a change keeps scores stable, point
+--openai-base-url at the real API (OPENAI_API_KEY from the environment).
+Requires ffmpeg/ffprobe on PATH.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import requests
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+DATA_DIR = BENCH_DIR / ".data"
+BUCKET = "bench"
+
+# app.py settings recorded with every run
+CONFIG_KEYS = [
+    "FPS",
+    "MAX_FRAMES_TO_ANALYZE",
+    "FRAME_ANALYSIS_CONCURRENCY",
+    "VISION_BATCH_SIZE",
+    "FRAME_EXTRACTION_MODE",
+    "FRAME_SELECTION_MODE",
+    "ADAPTIVE_COARSE_FRAMES",
+    "ADAPTIVE_MAX_FRAMES",
+    "FRAME_SOURCE",
+    "IMAGE_TILE_GRID",
+    "IMAGE_JPEG_QSCALE",
+    "IMAGE_MAX_BYTES",
+    "IMAGE_DETAIL",
+    "IMAGE_MOTION_CROP",
+    "SUMMARY_STREAM",
+    "STRUCTURED_OUTPUTS",
+    "STRUCTURED_OUTPUT_RETRIES",
+    "CACHE_ENABLED",
+    "RATE_GOVERNOR_ENABLED",
+    "VISION_MODEL",
+    "SUMMARY_MODEL",
+]
+
+
+# Structured-output counters from each job's "usage"
+JSON_OUTCOMES = ["json_repairs", "json_retries", "json_fallbacks"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--durations", default="10,60", help="Video lengths in seconds (default: 10,60)")
+    parser.add_argument("--resolutions", default="640x360,1280x720", help="Video sizes (default: 640x360,1280x720)")
+    parser.add_argument("--video-fps", type=int, default=30, help="Frame rate of the synthetic videos (default: 30)")
+    parser.add_argument("--concurrency", default="1,4,8", help="Concurrent /upload requests per level (default: 1,4,8)")
+    parser.add_argument("--jobs", type=int, default=16, help="Jobs per concurrency level (default: 16)")
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured jobs before the first level (default: 1)")
+    parser.add_argument("--openai-latency-ms", type=float, default=800, help="Base fake OpenAI latency (default: 800)")
+    parser.add_argument("--openai-latency-per-image-ms", type=float, default=200, help="Added per image (default: 200)")
+    parser.add_argument("--openai-latency-per-1k-tokens-ms", type=float, default=10,
+                        help="Added per 1000 prompt tokens (default: 10)")
+    parser.add_argument("--openai-jitter-ms", type=float, default=400, help="Random latency added (default: 400)")
+    parser.add_argument("--openai-429-rate", type=float, default=0.0, help="Fraction of calls answered 429 (default: 0)")
+    parser.add_argument("--openai-malformed-rate", type=float, default=0.0,
+                        help="Fraction of JSON replies mangled like a model's (default: 0)")
+    parser.add_argument("--openai-rpm", type=int, default=0, help="Fake account RPM limit, 0 = none (default: 0)")
+    parser.add_argument("--openai-tpm", type=int, default=0, help="Fake account TPM limit, 0 = none (default: 0)")
+    parser.add_argument("--storage-bandwidth", type=int, default=50 * 1024 * 1024,
+                        help="Fake storage bytes/sec per download, 0 = unlimited (default: 50 MiB/s)")
+    parser.add_argument("--sample-interval", type=float, default=0.02, help="RSS/disk sampling period in seconds")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the fake OpenAI server's randomness")
+    parser.add_argument("--openai-base-url",
+                        help="Send OpenAI calls here (e.g. https://api.openai.com/v1) instead of the fake server")
+    parser.add_argument("--cache", action="store_true", help="Leave the result cache on")
+    parser.add_argument("--out", help="Write the JSON report here (default: stdout)")
+    parser.add_argument("--baseline", help="Earlier JSON report to print a comparison against")
+    parser.add_argument("--verbose", action="store_true", help="Show the service's own log lines")
+    return parser.parse_args()
+
+
+def generate_videos(durations: List[float], resolutions: List[str], fps: int) -> List[Dict]:
+    """Render testsrc videos into the fake storage bucket, reusing ones already there."""
+    bucket_dir = DATA_DIR / "storage" / BUCKET
+    bucket_dir.mkdir(parents=True, exist_ok=True)
+    videos = []
+    for duration in durations:
+        for resolution in resolutions:
+            name = f"testsrc_{resolution}_{duration:g}s_{fps}fps.mp4"
+            path = bucket_dir / name
+            if not path.exists():
+                tmp_path = path.with_suffix(".tmp.mp4")
+                subprocess.run(
+                    [
+                        "ffmpeg", "-y", "-loglevel", "error",
+                        "-f", "lavfi", "-i", f"testsrc=duration={duration}:size={resolution}:rate={fps}",
+                        "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+                        str(tmp_path),
+                    ],
+                    check=True,
+                )
+                tmp_path.rename(path)
+            videos.append({
+                "name": name,
+                "duration": duration,
+                "resolution": resolution,
+                "bytes": path.stat().st_size,
+            })
+    return videos
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def start_server(script: str, env: Dict[str, str], port_var: str):
+    """Run a bench/ stand-in server as a subprocess; yields its base URL."""
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, str(BENCH_DIR / script)],
+        env={**os.environ, **env, port_var: str(port)},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + 15
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+                break
+            except OSError:
+                if proc.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"{script} did not start")
+                time.sleep(0.1)
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def percentiles(values: List[float]) -> Dict:
+    if not values:
+        return {"p50": None, "p95": None}
+    return {
+        "p50": round(float(np.percentile(values, 50)), 3),
+        "p95": round(float(np.percentile(values, 95)), 3),
+    }
+
+
+def current_rss() -> int:
+    """Resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+
+    # Peak, not current, where /proc is unavailable (bytes on macOS, KiB on Linux)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if platform.system() == "Darwin" else peak * 1024
+
+
+def dir_bytes(paths: List[Path]) -> int:
+    total = 0
+    for root in paths:
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                try:
+                    total += os.stat(os.path.join(dirpath, filename)).st_size
+                except FileNotFoundError:
+                    continue
+    return total
+
+
+class ResourceSampler:
+    """
+    Samples RSS and temp disk in the background and keeps the peaks, overall and
+    for each pipeline stage that was running at the time (stages of concurrent
+    jobs overlap, so a sample counts toward every stage active when it was taken).
+    """
+
+    def __init__(self, temp_dirs: List[Path], interval: float):
+        self.temp_dirs = temp_dirs
+        self.interval = interval
+        self.active: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.peak_rss = 0
+            self.peak_disk = 0
+            self.stage_peaks: Dict[str, Dict[str, int]] = {}
+
+    def enter(self, stage: str) -> None:
+        with self._lock:
+            self.active[stage] = self.active.get(stage, 0) + 1
+        self.sample()
+
+    def exit(self, stage: str) -> None:
+        self.sample()
+        with self._lock:
+            self.active[stage] -= 1
+
+    def sample(self) -> None:
+        rss = current_rss()
+        disk = dir_bytes(self.temp_dirs)
+        with self._lock:
+            self.peak_rss = max(self.peak_rss, rss)
+            self.peak_disk = max(self.peak_disk, disk)
+            for stage, count in self.active.items():
+                if count:
+                    peaks = self.stage_peaks.setdefault(stage, {"rss": 0, "disk": 0})
+                    peaks["rss"] = max(peaks["rss"], rss)
+                    peaks["disk"] = max(peaks["disk"], disk)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="bench-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def instrument_stages(app_module, sampler: ResourceSampler) -> None:
+    """Report every JobTelemetry stage to the sampler."""
+    original_stage = app_module.JobTelemetry.stage
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        sampler.enter(name)
+        try:
+            with original_stage(self, name):
+                yield
+        finally:
+            sampler.exit(name)
+
+    app_module.JobTelemetry.stage = stage
+
+
+def openai_stats(openai_url: str, reset: bool = False) -> Dict:
+    if openai_url is None:
+        # A real endpoint: token totals are in each job's "usage" instead
+        return {}
+    if reset:
+        requests.post(f"{openai_url}/stats/reset", timeout=5)
+        return {}
+    return requests.get(f"{openai_url}/stats", timeout=5).json()
+
+
+def score_stats(results: List[Dict]) -> Dict:
+    """
+    Per video: mean overallScore and mean per-frame skill_score over its jobs, and
+    the spread (max - min) of each across those jobs. A change that keeps scores
+    stable keeps the means close to the baseline's and the spreads no wider.
+    """
+    stats = {}
+    for name in sorted({r["video"] for r in results}):
+        runs = [r for r in results if r["video"] == name]
+        stats[name] = {"jobs": len(runs)}
+        for key in ("overall_score", "mean_skill_score"):
+            values = [r[key] for r in runs if r[key] is not None]
+            stats[name][key] = round(float(np.mean(values)), 2) if values else None
+            stats[name][f"{key}_spread"] = round(float(max(values) - min(values)), 2) if values else None
+    return stats
+
+
+def run_level(app_module, videos: List[Dict], concurrency: int, jobs: int, sampler: ResourceSampler,
+              openai_url: str) -> Dict:
+    """Send `jobs` /upload requests, `concurrency` at a time, cycling through the videos."""
+
+    def one_job(n: int) -> Dict:
+        video = videos[n % len(videos)]
+        start = time.monotonic()
+        resp = app_module.app.test_client().post(
+            "/upload", json={"videoPath": video["name"], "bucket": BUCKET}
+        )
+        seconds = time.monotonic() - start
+        body = resp.get_json(silent=True) or {}
+        skill_scores = [a.get("skill_score") or 0 for a in body.get("frame_analyses") or []]
+        return {
+            "video": video["name"],
+            "status": resp.status_code,
+            "seconds": seconds,
+            "stages": (body.get("timings") or {}).get("stages", {}),
+            "frames": len(body.get("frame_analyses") or []),
+            "vision_calls": (body.get("usage") or {}).get("vision_calls"),
+            "prompt_tokens": (body.get("usage") or {}).get("prompt_tokens"),
+            "json": {key: (body.get("usage") or {}).get(key) or 0 for key in JSON_OUTCOMES},
+            "overall_score": (body.get("metrics") or {}).get("overallScore"),
+            "mean_skill_score": float(np.mean(skill_scores)) if skill_scores else None,
+            "error": body.get("error"),
+        }
+
+    openai_stats(openai_url, reset=True)
+    sampler.reset()
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one_job, range(jobs)))
+    wall = time.monotonic() - start
+
+    ok = [r for r in results if r["status"] == 200]
+    stage_names = sorted({stage for r in ok for stage in r["stages"]})
+    stages = {}
+    for stage in stage_names:
+        peaks = sampler.stage_peaks.get(stage, {})
+        stages[stage] = {
+            **percentiles([r["stages"][stage] for r in ok if stage in r["stages"]]),
+            "peak_rss_mb": round(peaks.get("rss", 0) / 2**20, 1),
+            "peak_temp_disk_mb": round(peaks.get("disk", 0) / 2**20, 1),
+        }
+
+    return {
+        "concurrency": concurrency,
+        "jobs": jobs,
+        "ok": len(ok),
+        "errors": sorted({f"{r['status']}: {r['error']}" for r in results if r["status"] != 200}),
+        "wall_seconds": round(wall, 3),
+        "jobs_per_minute": round(len(ok) / wall * 60, 2) if wall else None,
+        "latency_seconds": percentiles([r["seconds"] for r in ok]),
+        "frames_per_job": round(float(np.mean([r["frames"] for r in ok])), 2) if ok else None,
+        "vision_calls_per_job": (
+            round(float(np.mean([r["vision_calls"] for r in ok])), 2)
+            if ok and all(r["vision_calls"] is not None for r in ok) else None
+        ),
+        "prompt_tokens_per_job": (
+            round(float(np.mean([r["prompt_tokens"] for r in ok])), 1)
+            if ok and all(r["prompt_tokens"] is not None for r in ok) else None
+        ),
+        "scores": score_stats(ok),
+        "json_per_job": {
+            key: round(float(np.mean([r["json"][key] for r in ok])), 3) if ok else None for key in JSON_OUTCOMES
+        },
+        "peak_rss_mb": round(sampler.peak_rss / 2**20, 1),
+        "peak_temp_disk_mb": round(sampler.peak_disk / 2**20, 1),
+        "stages": stages,
+        "openai": openai_stats(openai_url),
+    }
+
+
+def git_revision() -> Dict:
+    def _git(*args):
+        try:
+            return subprocess.run(
+                ["git", *args], cwd=REPO_DIR, capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    return {"commit": _git("rev-parse", "HEAD"), "dirty": bool(_git("status", "--porcelain", "--", "app.py"))}
+
+
+def _cell(old_value, new_value):
+    if old_value is None or new_value is None:
+        return f"{old_value} -> {new_value}"
+    return f"{old_value:>7} -> {new_value:<7}"
+
+
+def print_comparison(report: Dict, baseline: Dict) -> None:
+    """
+    Per-level p50/p95 latency, jobs/minute, peak RSS and prompt tokens per job,
+    then each video's mean scores and their spread, baseline -> this run.
+    """
+    old_levels = {level["concurrency"]: level for level in baseline.get("levels", [])}
+    print(f"baseline {(baseline.get('git') or {}).get('commit')} -> {(report.get('git') or {}).get('commit')}",
+          file=sys.stderr)
+    print(
+        f"{'conc':>5} {'p50 s':>17} {'p95 s':>17} {'jobs/min':>19} {'peak RSS MB':>19} {'tokens/job':>21}",
+        file=sys.stderr,
+    )
+    for level in report["levels"]:
+        old = old_levels.get(level["concurrency"])
+        if old is None:
+            continue
+        print(
+            f"{level['concurrency']:>5}"
+            f" {_cell(old['latency_seconds']['p50'], level['latency_seconds']['p50']):>17}"
+            f" {_cell(old['latency_seconds']['p95'], level['latency_seconds']['p95']):>17}"
+            f" {_cell(old['jobs_per_minute'], level['jobs_per_minute']):>19}"
+            f" {_cell(old['peak_rss_mb'], level['peak_rss_mb']):>19}"
+            f" {_cell(old.get('prompt_tokens_per_job'), level.get('prompt_tokens_per_job')):>21}",
+            file=sys.stderr,
+        )
+
+    # Every level runs the same videos, so the first level's scores stand for the run
+    level = report["levels"][0] if report["levels"] else {}
+    old_scores = (old_levels.get(level.get("concurrency")) or {}).get("scores") or {}
+    print(f"{'video':<40} {'overallScore (spread)':>33} {'skill_score (spread)':>33}", file=sys.stderr)
+    for name, new in (level.get("scores") or {}).items():
+        old = old_scores.get(name)
+        if old is None:
+            continue
+        columns = [
+            f"{old[key]} ({old[key + '_spread']}) -> {new[key]} ({new[key + '_spread']})"
+            for key in ("overall_score", "mean_skill_score")
+        ]
+        print(f"{name:<40} {columns[0]:>33} {columns[1]:>33}", file=sys.stderr)
+
+
+def main() -> None:
+    args = parse_args()
+    out_path = Path(args.out).resolve() if args.out else None
+    baseline_path = Path(args.baseline).resolve() if args.baseline else None
+    durations = [float(d) for d in args.durations.split(",")]
+    resolutions = args.resolutions.split(",")
+    levels = [int(c) for c in args.concurrency.split(",")]
+
+    videos = generate_videos(durations, resolutions, args.video_fps)
+
+    work_dir = DATA_DIR / f"work-{os.getpid()}"
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    storage_env = {
+        "FAKE_STORAGE_ROOT": str(DATA_DIR / "storage"),
+        "FAKE_STORAGE_BANDWIDTH": str(args.storage_bandwidth),
+    }
+    openai_env = {
+        "FAKE_LATENCY_MS": str(args.openai_latency_ms),
+        "FAKE_LATENCY_PER_IMAGE_MS": str(args.openai_latency_per_image_ms),
+        "FAKE_LATENCY_PER_1K_TOKENS_MS": str(args.openai_latency_per_1k_tokens_ms),
+        "FAKE_LATENCY_JITTER_MS": str(args.openai_jitter_ms),
+        "FAKE_429_RATE": str(args.openai_429_rate),
+        "FAKE_MALFORMED_RATE": str(args.openai_malformed_rate),
+        "FAKE_RPM_LIMIT": str(args.openai_rpm),
+        "FAKE_TPM_LIMIT": str(args.openai_tpm),
+        "FAKE_SEED": str(args.seed),
+    }
+
+    if args.openai_base_url:
+        fake_openai = contextlib.nullcontext(None)
+    else:
+        fake_openai = start_server("fake_openai.py", openai_env, "FAKE_OPENAI_PORT")
+
+    with start_server("fake_storage.py", storage_env, "FAKE_STORAGE_PORT") as storage_url, \
+            fake_openai as openai_url:
+        os.environ.update({"SUPABASE_URL": storage_url, "SUPABASE_SERVICE_ROLE_KEY": "bench"})
+        if openai_url:
+            os.environ.update({"OPENAI_API_KEY": "bench", "OPENAI_BASE_URL": f"{openai_url}/v1"})
+        else:
+            os.environ["OPENAI_BASE_URL"] = args.openai_base_url
+        if not args.cache:
+            os.environ["ANALYSIS_CACHE_ENABLED"] = "0"
+
+        # app.py keeps its uploads/, frames/ and cache/ relative to the working directory
+        os.chdir(work_dir)
+        sys.path.insert(0, str(REPO_DIR))
+        log = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+        with log:
+            import app as app_module
+
+            sampler = ResourceSampler([work_dir / "uploads", work_dir / "frames"], args.sample_interval)
+            instrument_stages(app_module, sampler)
+            sampler.start()
+            try:
+                if args.warmup:
+                    run_level(app_module, videos, 1, args.warmup, sampler, openai_url)
+                results = []
+                for concurrency in levels:
+                    results.append(run_level(app_module, videos, concurrency, args.jobs, sampler, openai_url))
+                    print(
+                        f"concurrency {concurrency}: p50 {results[-1]['latency_seconds']['p50']}s, "
+                        f"{results[-1]['jobs_per_minute']} jobs/min",
+                        file=sys.stderr,
+                    )
+            finally:
+                sampler.stop()
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "git": git_revision(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "config": {key: getattr(app_module, key, None) for key in CONFIG_KEYS},
+        "bench": {
+            key: value for key, value in vars(args).items() if key not in ("out", "baseline", "verbose")
+        },
+        "videos": videos,
+        "levels": results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if out_path:
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        out_path.write_text(text + "\n")
+    else:
+        print(text)
+
+    if baseline_path:
+        print_comparison(report, json.loads(baseline_path.read_text()))
+
+
+if __name__ == "__main__":
+    main()